@@ -0,0 +1,102 @@
+import numpy as np
+from time import time
+from sklearn.externals import joblib
+
+
+def top_k(sims, k):
+    """ Indices of the k largest values sorted by the value in the descending order. """
+
+    if k < len(sims):
+        indices = np.argpartition(-sims, k - 1)[:k]
+    else:
+        indices = np.arange(len(sims))
+
+    return indices[np.argsort(-sims[indices])]
+
+
+class IVFIndex(object):
+    """ An inverted file index for the approximate search of the nearest neighbours by the
+    dot product of normalised vectors: the vectors are clustered by the spherical k-means
+    and a query is compared only to the vectors of the 'n_probe' closest clusters.
+    The vectors themselves are not saved with the index, they are attached after loading. """
+
+    def __init__(self, n_lists=None, n_probe=8, n_iter=10, sample_size=100000, batch_size=10000, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self._n_iter = n_iter
+        self._sample_size = sample_size
+        self._batch_size = batch_size
+        self._seed = seed
+        self._vectors = None
+        self.centroids = None
+        self.order = None  # the vector ids sorted by the cluster
+        self.offsets = None  # the cluster i is self.order[offsets[i]:offsets[i+1]]
+
+    def __len__(self):
+        return 0 if self.order is None else len(self.order)
+
+    def _assign(self, vectors):
+        assignment = np.zeros(vectors.shape[0], dtype=np.int32)
+        for i in range(0, vectors.shape[0], self._batch_size):
+            batch = vectors[i:i + self._batch_size]
+            assignment[i:i + self._batch_size] = np.argmax(batch.dot(self.centroids.T), axis=1)
+        return assignment
+
+    def fit(self, vectors):
+        tic = time()
+        n = vectors.shape[0]
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(n)))
+        self.n_lists = min(self.n_lists, n)
+
+        rnd = np.random.RandomState(self._seed)
+        sample = vectors[rnd.choice(n, min(n, max(self._sample_size, self.n_lists)), replace=False)]
+        self.centroids = np.array(sample[rnd.choice(len(sample), self.n_lists, replace=False)])
+
+        for i in range(self._n_iter):
+            assignment = self._assign(sample)
+            for cluster in range(self.n_lists):
+                members = sample[assignment == cluster]
+                if len(members) > 0:
+                    centroid = members.sum(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    self.centroids[cluster] = centroid / norm if norm > 0 else centroid
+
+        assignment = self._assign(vectors)
+        self.order = np.argsort(assignment, kind="stable").astype(np.int64)
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(self.n_lists + 1))
+        self._vectors = vectors
+        print("Built an index of {} vectors in {} lists in {:.2f} sec.".format(n, self.n_lists, time() - tic))
+
+        return self
+
+    def attach(self, vectors):
+        if vectors.shape[0] != len(self):
+            raise ValueError("The index has {} vectors, but {} are attached.".format(len(self), vectors.shape[0]))
+        self._vectors = vectors
+
+    def search(self, query, k=10, n_probe=None):
+        """ Returns the ids of the approximate k nearest neighbours and their similarities. """
+
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        clusters = top_k(self.centroids.dot(query), n_probe)
+        ids = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+
+        sims = self._vectors[ids].dot(query)
+        best = top_k(sims, k)
+
+        return ids[best], sims[best]
+
+    def save(self, fpath):
+        vectors = self._vectors
+        self._vectors = None
+        try:
+            joblib.dump(self, fpath)
+        finally:
+            self._vectors = vectors
+
+    @staticmethod
+    def load(fpath, vectors):
+        index = joblib.load(fpath)
+        index.attach(vectors)
+        return index
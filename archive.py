@@ -0,0 +1,131 @@
+import gzip
+import json
+import atexit
+from os import getpid
+from os.path import join
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from time import time, strftime
+from traceback import format_exc
+from utils import ensure_dir
+
+
+QUEUE_SIZE = 10000
+SEGMENT_RECORDS = 10000  # a new segment file is started after this number of records
+BATCH_SIZE = 500
+
+
+def _text(data):
+    return str(data, "utf-8") if isinstance(data, bytes) else data
+
+
+class Archiver(object):
+    """ Archives the requests and the responses of the web services in the background: the
+    records are put into a bounded queue and a writer thread appends them in batches to gzipped
+    segment files with one JSON record per line. Other writes, e.g. to the dataset file, can be
+    submitted to the same thread, so they never interleave. If the queue is full, the records
+    are dropped instead of blocking the requests. """
+
+    def __init__(self, archive_dir, prefix="requests", queue_size=QUEUE_SIZE, segment_records=SEGMENT_RECORDS):
+        self._archive_dir = archive_dir
+        self._prefix = prefix
+        self._segment_records = segment_records
+        self._segment = None
+        self._segment_num = 0
+        self._segment_len = 0
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self.dropped = 0
+        self._closed = False
+
+        self._writer = Thread(target=self._write_loop, name="archiver", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def submit(self, function, *args):
+        """ Runs the function in the writer thread. Returns False if the queue is full. """
+
+        try:
+            self._queue.put_nowait((function, args))
+            return True
+        except Full:
+            with self._lock:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    print("Warning: the archive queue is full, {} records dropped.".format(self.dropped))
+            return False
+
+    def archive(self, route, request_data, response_data, contexts=None, phrases=None):
+        """ Archives a request and its response. The contexts and phrases extracted from the
+        request for linking are archived as well. """
+
+        record = {"time": time(),
+                  "route": route,
+                  "request": _text(request_data),
+                  "response": _text(response_data)}
+        if contexts is not None:
+            record["contexts"] = [str(context) for context in contexts]
+        if phrases is not None:
+            record["phrases"] = [[phrase.text, phrase.beg, phrase.end, str(phrase.subj)] for phrase in phrases]
+
+        return self.submit(self._write_record, record)
+
+    def _open_segment(self):
+        ensure_dir(self._archive_dir)
+        self._segment_num += 1
+        # the pid keeps apart the segments of several server processes archiving to the same directory
+        segment_fpath = join(self._archive_dir, "{}-{}-{}-{:04d}.jsonl.gz".format(
+            self._prefix, strftime("%Y%m%d-%H%M%S"), getpid(), self._segment_num))
+        self._segment = gzip.open(segment_fpath, "ab")
+        self._segment_len = 0
+
+    def _write_record(self, record):
+        if self._segment is None or self._segment_len >= self._segment_records:
+            if self._segment is not None: self._segment.close()
+            self._open_segment()
+
+        self._segment.write((json.dumps(record) + "\n").encode("utf-8"))
+        self._segment_len += 1
+
+    def _run(self, function, args):
+        try:
+            function(*args)
+        except:
+            print("Warning: cannot archive a record:", function.__name__)
+            print(format_exc())
+
+    def _write_loop(self):
+        while True:
+            task = self._queue.get()
+            if task is None: break
+
+            # write all the waiting records as one batch
+            self._run(*task)
+            stop = False
+            for i in range(BATCH_SIZE):
+                try:
+                    task = self._queue.get_nowait()
+                except Empty:
+                    break
+                if task is None:
+                    stop = True
+                    break
+                self._run(*task)
+
+            if self._segment is not None:
+                self._segment.flush()
+            if stop: break
+
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def close(self):
+        """ Writes the queued records and stops the writer thread. """
+
+        with self._lock:
+            if self._closed: return
+            self._closed = True
+
+        self._queue.put(None)
+        self._writer.join()
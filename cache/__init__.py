@@ -0,0 +1,74 @@
+from os.path import abspath
+from threading import Lock
+from cache.lru import TieredCache, DEFAULT_MEMORY_BYTES
+from cache.sqlite_store import BatchedSqliteStore
+
+
+_shared_caches = {}
+_shared_caches_lock = Lock()
+
+
+class SharedCache(object):
+    """ A handle to the process-wide cache of a database file. All the handles of
+    the same file share one connection pool and one in-memory tier; the cache is
+    closed when the last handle is closed. """
+
+    def __init__(self, fpath, cache):
+        self._fpath = fpath
+        self._cache = cache
+        self._closed = False
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def get_many(self, keys):
+        return self._cache.get_many(keys)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __getitem__(self, key):
+        return self._cache[key]
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+
+    def stats(self):
+        return self._cache.stats()
+
+    def flush(self):
+        self._cache.flush()
+
+    def close(self):
+        with _shared_caches_lock:
+            if self._closed: return
+            self._closed = True
+
+            cache, handles_num = _shared_caches[self._fpath]
+            if handles_num > 1:
+                _shared_caches[self._fpath] = (cache, handles_num - 1)
+            else:
+                del _shared_caches[self._fpath]
+                cache.close()
+
+
+def get_shared_cache(fpath, memory_bytes=DEFAULT_MEMORY_BYTES):
+    """ Returns a handle to the process-wide thread-safe cache stored in the file.
+    The size of its in-memory tier is set by the first caller. """
+
+    fpath = abspath(fpath)
+    with _shared_caches_lock:
+        if fpath in _shared_caches:
+            cache, handles_num = _shared_caches[fpath]
+        else:
+            cache, handles_num = TieredCache(BatchedSqliteStore(fpath), memory_bytes), 0
+        _shared_caches[fpath] = (cache, handles_num + 1)
+
+    return SharedCache(fpath, cache)
+
+
+def shared_cache_stats():
+    """ Returns the statistics of the in-memory tiers of all the shared caches. """
+
+    with _shared_caches_lock:
+        return {fpath: _shared_caches[fpath][0].stats() for fpath in _shared_caches}
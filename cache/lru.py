@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from threading import Lock
+from pickle import dumps, HIGHEST_PROTOCOL
+
+
+DEFAULT_CAPACITY = 100000  # entries
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024  # the size of the in-memory tier of a persistent cache
+_MISSING = object()
+
+
+def pickled_size(key, value):
+    """ The approximate memory size of a cache entry: the length of the key and of
+    the pickled value, i.e. of the entry in the persistent store. """
+
+    return len(key) + len(dumps(value, protocol=HIGHEST_PROTOCOL))
+
+
+class LRUCache(object):
+    """ A bounded in-memory cache which evicts the least recently used entries when
+    the number of entries exceeds the capacity or, if sizeof(key, value) is given,
+    when the total size of the entries exceeds the capacity. """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, sizeof=None):
+        self._capacity = capacity
+        self._sizeof = sizeof
+        self._size = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+
+    def put(self, key, value):
+        if self._capacity <= 0: return
+        size = self._sizeof(key, value) if self._sizeof is not None else 1
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None: self._size -= old_entry[1]
+            if size > self._capacity: return  # an entry larger than the whole cache is not kept
+
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self._capacity:
+                evicted_key, (evicted_value, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total > 0 else 0.0
+
+    def stats(self):
+        return {"size": len(self._entries),
+                "used": self._size,
+                "capacity": self._capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate()}
+
+
+class TieredCache(object):
+    """ A dictionary-like cache which keeps the recently used entries of a persistent
+    store (e.g. a SqliteDict) in memory: the store is accessed only on a memory miss.
+    The memory tier holds at most memory_bytes of the entries (see pickled_size). """
+
+    def __init__(self, store, memory_bytes=DEFAULT_MEMORY_BYTES):
+        self._store = store
+        self._memory = LRUCache(memory_bytes, pickled_size)
+
+    def get(self, key, default=None):
+        value = self._memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        value = self._store.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        else:
+            self._memory.put(key, value)
+            return value
+
+    def get_many(self, keys):
+        """ Looks up several keys at once: returns a dictionary with the found keys. """
+
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._memory.get(key, _MISSING)
+            if value is _MISSING: missing.append(key)
+            else: found[key] = value
+
+        if len(missing) == 0:
+            return found
+
+        if hasattr(self._store, "get_many"):
+            stored = self._store.get_many(missing)
+        else:
+            stored = {key: self._store[key] for key in missing if key in self._store}
+
+        for key in stored:
+            self._memory.put(key, stored[key])
+        found.update(stored)
+
+        return found
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._store[key] = value
+        self._memory.put(key, value)
+
+    def stats(self):
+        return self._memory.stats()
+
+    def flush(self):
+        if hasattr(self._store, "flush"):
+            self._store.flush()
+
+    def close(self):
+        self._memory.clear()
+        self._store.close()
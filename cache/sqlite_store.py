@@ -0,0 +1,163 @@
+import sqlite3
+import atexit
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from threading import Lock, Event, Thread
+from weakref import WeakSet
+from contextlib import contextmanager
+
+
+DEFAULT_FLUSH_COUNT = 1000
+DEFAULT_FLUSH_INTERVAL = 5.0  # seconds
+DEFAULT_POOL_SIZE = 8
+_MISSING = object()
+_open_stores = WeakSet()
+
+
+@atexit.register
+def _close_open_stores():
+    for store in list(_open_stores):
+        store.close()
+
+
+class BatchedSqliteStore(object):
+    """ A persistent dictionary-like store in an SQLite database in the WAL mode.
+    The writes are buffered in memory and flushed in a single transaction once
+    'flush_count' writes are pending or every 'flush_interval' seconds, and on close.
+    The reads use a pool of connections, so the concurrent readers do not block each other.
+    The table layout is the one of SqliteDict, so the existing cache files can be used. """
+
+    def __init__(self, fpath, tablename="unnamed", flush_count=DEFAULT_FLUSH_COUNT,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, pool_size=DEFAULT_POOL_SIZE):
+        self._fpath = fpath
+        self._tablename = tablename
+        self._flush_count = flush_count
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._write_lock = Lock()
+        self._pool_size = pool_size
+        self._pool = []
+        self._pool_lock = Lock()
+        self._closed = False
+
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value BLOB)'.format(tablename))
+            conn.commit()
+
+        self._stop = Event()
+        self._flusher = None
+        if flush_interval and flush_interval > 0:
+            self._flusher = Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True)
+            self._flusher.start()
+
+        _open_stores.add(self)
+
+    @contextmanager
+    def _connection(self):
+        """ Takes a connection from the pool and returns it back after use. """
+
+        with self._pool_lock:
+            conn = self._pool.pop() if len(self._pool) > 0 else None
+
+        if conn is None:
+            conn = sqlite3.connect(self._fpath, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+        try:
+            yield conn
+        finally:
+            with self._pool_lock:
+                if len(self._pool) < self._pool_size and not self._closed:
+                    self._pool.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def _flush_periodically(self, flush_interval):
+        while not self._stop.wait(flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print("Warning: cannot flush the cache '{}': {}".format(self._fpath, e))
+
+    def get(self, key, default=None):
+        with self._pending_lock:
+            value = self._pending.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT value FROM "{}" WHERE key = ?'.format(self._tablename), (key,)).fetchone()
+
+        return default if row is None else loads(bytes(row[0]))
+
+    def get_many(self, keys):
+        """ Looks up several keys at once: returns a dictionary with the found keys. """
+
+        found = {}
+        missing = []
+        with self._pending_lock:
+            for key in keys:
+                if key in self._pending: found[key] = self._pending[key]
+                else: missing.append(key)
+
+        batch_size = 500  # below the limit on the number of SQLite variables
+        with self._connection() as conn:
+            for i in range(0, len(missing), batch_size):
+                batch = missing[i:i + batch_size]
+                rows = conn.execute('SELECT key, value FROM "{}" WHERE key IN ({})'.format(
+                    self._tablename, ",".join("?" * len(batch))), batch)
+                for key, value in rows:
+                    found[key] = loads(bytes(value))
+
+        return found
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._pending_lock:
+            self._pending[key] = value
+            pending_num = len(self._pending)
+
+        if pending_num >= self._flush_count:
+            self.flush()
+
+    def flush(self):
+        """ Writes all the pending entries in one transaction. """
+
+        with self._write_lock:
+            with self._pending_lock:
+                if len(self._pending) == 0: return
+                written = dict(self._pending)
+
+            items = [(key, sqlite3.Binary(dumps(value, protocol=HIGHEST_PROTOCOL)))
+                     for key, value in written.items()]
+            with self._connection() as conn, conn:
+                conn.executemany('REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(self._tablename), items)
+
+            # the entries updated during the write stay pending
+            with self._pending_lock:
+                for key, value in written.items():
+                    if self._pending.get(key, _MISSING) is value:
+                        del self._pending[key]
+
+    def close(self):
+        if self._closed: return
+
+        self._stop.set()
+        self.flush()
+        self._closed = True
+        _open_stores.discard(self)
+
+        with self._pool_lock:
+            for conn in self._pool:
+                conn.close()
+            self._pool = []
@@ -1,5 +1,5 @@
-from collections import namedtuple
-from namedlist import namedlist
+from collections import namedtuple, OrderedDict
+from hashlib import blake2b
 import codecs
 
 Phrase = namedtuple("Phrase", "text beg end subj")
@@ -17,7 +17,8 @@ Phrase = namedtuple("Phrase", "text beg end subj")
 #        return self.get_hash() == other.get_hash()
 
 
-CandidateBase = namedlist("CandidateBase", "score name link wiki types names uris text db_uri importance relations")
+CANDIDATE_FIELDS = ("score", "name", "link", "wiki", "types", "names", "uris", "text",
+                    "db_uri", "importance", "relations")
 
 
 def make_phrases(str_phrases):
@@ -27,25 +28,79 @@ def make_phrases(str_phrases):
                    for phrase in str_phrases]
 
 
-class Candidate(CandidateBase):
+def fingerprint(name, uris, types):
+    """ A stable 64-bit fingerprint of a candidate identity: the same in all processes
+    (unlike the built-in hash of a string) and independent of the order of a set of uris. """
+
+    uris = "".join(sorted(uris) if isinstance(uris, (set, frozenset)) else uris) if uris is not None else ""
+    types = "".join(types) if types is not None else ""
+    hash_str = (name or "") + uris + types
+
+    return int.from_bytes(blake2b(hash_str.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class Candidate(object):
+    """ A candidate entity of a phrase. A candidate is identified by its name, uris and types:
+    the fingerprint of these fields is computed once and is reset when one of them is set. """
+
+    __slots__ = ("score", "_name", "link", "wiki", "_types", "names", "_uris", "text",
+                 "db_uri", "importance", "relations", "_fingerprint")
+    _fields = CANDIDATE_FIELDS
+
     def __init__(self, score=0.0, name="", link="", wiki="", types=[], names=[], uris=[], text="",
                  db_uri="", importance=1.0, relations={}):
-       CandidateBase.__init__(self, score, name, link, wiki, types, names, uris, text,
-                              db_uri, importance, relations)
+        self.score = score
+        self._name = name
+        self.link = link
+        self.wiki = wiki
+        self._types = types
+        self.names = names
+        self._uris = uris
+        self.text = text
+        self.db_uri = db_uri
+        self.importance = importance
+        self.relations = relations
+        self._fingerprint = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+        self._fingerprint = None
+
+    @property
+    def uris(self):
+        return self._uris
+
+    @uris.setter
+    def uris(self, value):
+        self._uris = value
+        self._fingerprint = None
+
+    @property
+    def types(self):
+        return self._types
+
+    @types.setter
+    def types(self, value):
+        self._types = value
+        self._fingerprint = None
 
     def get_hash(self):
-        uris = "".join(self.uris) if self.uris is not None else ""
-        types = "".join(self.types) if self.types is not None else ""
-        hash_str = self.name + uris + types
-        if hash_str is None:
-            print("Warning: hash string is none.")
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self._name, self._uris, self._types)
 
-        return hash(hash_str)
+        return self._fingerprint
 
     def __hash__(self):
         return self.get_hash()
-    
+
     def __eq__(self, other):
+        if not isinstance(other, Candidate):
+            return NotImplemented
         return self.get_hash() == other.get_hash()
 
     def __gt__(self, other):
@@ -54,6 +109,38 @@ class Candidate(CandidateBase):
     def __lt__(self, other):
        return self.score < other.score
 
+    def __iter__(self):
+        return (getattr(self, field) for field in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        return getattr(self, self._fields[index])
+
+    def __repr__(self):
+        return "Candidate({})".format(", ".join(
+            "{}={!r}".format(field, getattr(self, field)) for field in self._fields))
+
+    def __getstate__(self):
+        return tuple(self)
+
+    def __setstate__(self, state):
+        # also reads the candidates pickled as a namedlist by the older versions
+        self._fingerprint = None
+        for field, value in zip(self._fields, state):
+            setattr(self, field, value)
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self))
+
+    def _replace(self, **fields):
+        other = Candidate(*self)
+        other._fingerprint = self._fingerprint
+        for field, value in fields.items():
+            setattr(other, field, value)
+        return other
+
 
 def save_candidates_text(output_fpath="data/sf-candidates.txt"):
     re_newlines = re.compile(r"[\n\r]+")
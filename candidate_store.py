@@ -0,0 +1,146 @@
+import numpy as np
+import json
+import codecs
+from os.path import join, exists
+from time import time
+from candidate import Candidate, Phrase
+from utils import ensure_dir
+
+
+STRING_FIELDS = ["name", "link", "wiki", "text", "db_uri"]
+JSON_FIELDS = ["types", "names", "uris", "relations"]
+FLOAT_FIELDS = ["score", "importance"]
+PHRASES_FILENAME = "phrases.txt"
+
+
+def phrase_key(phrase):
+    """ The key of a phrase in the store: the stripped text of a phrase or a string
+    as is (e.g. the Diffbot URI of a related entity). """
+
+    return phrase.text.strip() if isinstance(phrase, Phrase) else phrase
+
+
+class StringColumn(object):
+    """ A memory-mapped column of strings: a utf-8 blob and the offsets of the strings. """
+
+    def __init__(self, column_fpath):
+        self._offsets = np.load(column_fpath + ".offsets.npy", mmap_mode="r")
+        if self._offsets[-1] > 0:
+            self._blob = np.memmap(column_fpath + ".bin", dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.zeros(0, dtype=np.uint8)  # an empty file can not be mapped
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._blob[self._offsets[index]:self._offsets[index + 1]].tobytes().decode("utf-8")
+
+    @staticmethod
+    def save(column_fpath, strings):
+        offsets = [0]
+        with open(column_fpath + ".bin", "wb") as blob:
+            for string in strings:
+                data = string.encode("utf-8")
+                blob.write(data)
+                offsets.append(offsets[-1] + len(data))
+        np.save(column_fpath + ".offsets.npy", np.array(offsets, dtype=np.int64))
+
+
+class CandidateStore(object):
+    """ A columnar store of the candidates of a model: the candidates are identified by
+    their integer ids (the rows of the candidate feature matrix), their fields are stored
+    in memory-mapped columns, and the candidate ids of the phrases are stored in CSR-like
+    arrays: the ids of the phrase i are phrase_candidates[phrase_offsets[i]:phrase_offsets[i+1]].
+    A candidate is built only when it is read. """
+
+    def __init__(self, store_dir):
+        tic = time()
+
+        self._strings = {field: StringColumn(join(store_dir, field)) for field in STRING_FIELDS + JSON_FIELDS}
+        self._floats = {field: np.load(join(store_dir, field + ".npy"), mmap_mode="r") for field in FLOAT_FIELDS}
+        self._phrase_offsets = np.load(join(store_dir, "phrase_offsets.npy"), mmap_mode="r")
+        self._phrase_candidates = np.load(join(store_dir, "phrase_candidates.npy"), mmap_mode="r")
+
+        self._phrase2id = {}
+        with codecs.open(join(store_dir, PHRASES_FILENAME), "r", "utf-8") as phrases_f:
+            for phrase_id, line in enumerate(phrases_f):
+                self._phrase2id[json.loads(line)] = phrase_id
+
+        print("Loaded {} candidates of {} phrases in {:.2f} sec.".format(
+            len(self), len(self._phrase2id), time() - tic))
+
+    def __len__(self):
+        return len(self._floats["score"])
+
+    def __contains__(self, phrase):
+        return phrase_key(phrase) in self._phrase2id
+
+    def phrase_candidate_ids(self, phrase):
+        """ Returns an int32 array with the ids of the candidates of the phrase. """
+
+        phrase_id = self._phrase2id.get(phrase_key(phrase))
+        if phrase_id is None:
+            return np.zeros(0, dtype=np.int32)
+
+        return self._phrase_candidates[self._phrase_offsets[phrase_id]:self._phrase_offsets[phrase_id + 1]]
+
+    def get(self, candidate_id):
+        fields = {field: self._strings[field][candidate_id] for field in STRING_FIELDS}
+        fields.update({field: json.loads(self._strings[field][candidate_id]) for field in JSON_FIELDS})
+        fields.update({field: float(self._floats[field][candidate_id]) for field in FLOAT_FIELDS})
+        fields["uris"] = set(fields["uris"])
+
+        return Candidate(**fields)
+
+    def get_field(self, field, candidate_ids):
+        """ Returns the values of a string or float field of several candidates. """
+
+        if field in self._floats:
+            return self._floats[field][candidate_ids]
+        else:
+            return [self._strings[field][candidate_id] for candidate_id in candidate_ids]
+
+    @staticmethod
+    def exists(store_dir):
+        return exists(join(store_dir, PHRASES_FILENAME))
+
+    @staticmethod
+    def save(store_dir, candidate2index, phrase2candidates):
+        """ Saves the candidates indexed by candidate2index and the candidate ids
+        of the phrases. The candidates that are not indexed are skipped. """
+
+        tic = time()
+        ensure_dir(store_dir)
+
+        index2candidate = [None] * len(candidate2index)
+        for candidate, index in candidate2index.items():
+            index2candidate[index] = candidate
+
+        for field in STRING_FIELDS:
+            StringColumn.save(join(store_dir, field), (getattr(c, field) or "" for c in index2candidate))
+
+        for field in JSON_FIELDS:
+            def to_json(value):
+                if value is None: value = {} if field == "relations" else []
+                return json.dumps(value if isinstance(value, dict) else list(value))
+            StringColumn.save(join(store_dir, field), (to_json(getattr(c, field)) for c in index2candidate))
+
+        for field in FLOAT_FIELDS:
+            np.save(join(store_dir, field + ".npy"),
+                    np.array([float(getattr(c, field)) for c in index2candidate], dtype=np.float64))
+
+        offsets = [0]
+        candidate_ids = []
+        with codecs.open(join(store_dir, PHRASES_FILENAME), "w", "utf-8") as phrases_f:
+            for phrase in phrase2candidates:
+                ids = [candidate2index[c] for c in phrase2candidates[phrase] if c in candidate2index]
+                candidate_ids += ids
+                offsets.append(len(candidate_ids))
+                phrases_f.write("{}\n".format(json.dumps(phrase_key(phrase))))
+
+        np.save(join(store_dir, "phrase_offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(join(store_dir, "phrase_candidates.npy"), np.array(candidate_ids, dtype=np.int32))
+
+        print("Saved {} candidates of {} phrases in {:.2f} sec.: {}".format(
+            len(index2candidate), len(offsets) - 1, time() - tic, store_dir))
@@ -1,9 +1,9 @@
 from wikidata.client import Client
 from traceback import format_exc
-from sqlitedict import SqliteDict
 from traceback import format_exc
 from os.path import join
 from utils import ROOT_DIR
+from cache import get_shared_cache
 
 
 WIKIDATA_DOMAIN = "wikidata.org"
@@ -12,13 +12,14 @@ WIKIDATA_PREFIX = "wikidata.org/wiki/"
 DBPEDIA_PREFIX = "http://dbpedia.org/resource/"
 WIKIPEDIA_PREFIX = "wikipedia.org/wiki/"
 CACHED_WIKI2DBPEDIA_DB = join(join(ROOT_DIR, "cache"), "wikidata2dbpedia-cache.sqlite")
+CACHED_WIKI2DBPEDIA_MEMORY_BYTES = 16 * 1024 * 1024
 
 verbose = False
   
 
 class URIConverter(object):
-    def __init__(self, cache_fpath=CACHED_WIKI2DBPEDIA_DB):
-        self._cache = SqliteDict(cache_fpath, autocommit=True)
+    def __init__(self, cache_fpath=CACHED_WIKI2DBPEDIA_DB, memory_bytes=CACHED_WIKI2DBPEDIA_MEMORY_BYTES):
+        self._cache = get_shared_cache(cache_fpath, memory_bytes)
         self._client = Client()
 
     def __del__(self):
@@ -30,6 +31,11 @@ class URIConverter(object):
     def close(self):
         self._cache.close()
 
+    def cache_stats(self):
+        """ Hit/miss counters of the in-memory cache tier. """
+
+        return self._cache.stats()
+
     def get_postfix(self, string, prefix):
         """ Given a string and a prefix returns postfix. If not found 
         then returns None. """
@@ -60,8 +66,9 @@ class URIConverter(object):
 
     def wikidataid2wikipedia(self, wikidata_q_id="Q42"):
         try:
-            if wikidata_q_id in self._cache:
-                return self._cache[wikidata_q_id]
+            wikipedia_uri = self._cache.get(wikidata_q_id)
+            if wikipedia_uri is not None:
+                return wikipedia_uri
             else:
                 entity = self._client.get(wikidata_q_id, load=True)
                 can_get = ("sitelinks" in entity.attributes and
@@ -1,11 +1,15 @@
-import requests
 import json
 import codecs
-import grequests 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from requests import RequestException
 from sqlitedict import SqliteDict
 from utils import ROOT_DIR
+from cache import get_shared_cache
 from os.path import join
+from os import replace
 from time import time
+import http_client
 
 
 endpoint_diffbot = "http://kg.diffbot.com/kg/dql_endpoint"
@@ -25,43 +29,254 @@ EL_POL_ENTITY_TYPES = ["AdministrativeArea", "Corporation", "EducationalInstitut
                    "Person", "Place", "Product"]
 
 CACHED_QUERY_DB =  join(join(ROOT_DIR, "cache"), "diffbot-query-cache.sqlite")
+CACHED_QUERY_MEMORY_BYTES = 32 * 1024 * 1024  # a response of a common name is tens of kilobytes
+
+# The fields of the hits that are read by the linkers: only these are cached
+HIT_FIELDS = ["allUris", "origin", "origins", "wikipediaUri", "importance", "name",
+              "types", "allNames", "description", "diffbotUri"]
+# ALL_RELATED_FIELDS = ["founders", "categories", "ceo", "isPartOf",
+#                        "skills", "parents", "children", "parentCompany"]
+RELATED_FIELDS = ["founders", "ceo", "parentCompany", "isPartOf"]
+RELATED_HIT_FIELDS = ["diffbotUri", "name"]
+
+# The number of hits of a DQL query without the size parameter, i.e. of a 'type:X name:"..."'
+# query: a types query reads pages until it has as many hits of each of its types.
+DQL_PAGE_SIZE = 25
+# At most this number of pages of a types query are read: the types that still have less
+# than DQL_PAGE_SIZE hits are queried one by one by the 'type:X name:"..."' queries.
+DQL_TYPES_QUERY_PAGES = 2
+
+
+def compact_hit(hit):
+    """ Keeps only the fields of a hit that are used by the linkers. """
+
+    compact = {field: hit[field] for field in HIT_FIELDS if field in hit}
+
+    for field in RELATED_FIELDS:
+        if field not in hit: continue
+
+        if isinstance(hit[field], dict):
+            compact[field] = {f: hit[field][f] for f in RELATED_HIT_FIELDS if f in hit[field]}
+        elif isinstance(hit[field], list):
+            compact[field] = [{f: item[f] for f in RELATED_HIT_FIELDS if f in item}
+                              for item in hit[field] if isinstance(item, dict)]
+
+    return compact
+
+
+class QueryFailed(Exception):
+    """ The DQL query has no valid response: it is not cached and can be sent again later. """
+    pass
+
+
+def compact_response(response):
+    """ Converts a raw DQL response to a compact dictionary which is stored in the cache.
+    Returns None if the request failed: the status is not 200 (also after the retries of
+    the 429 and 5xx statuses), the body is not JSON or it is a JSON error. """
+
+    if response is None:
+        return None
+
+    if response.status_code != 200:
+        print("Warning: the query failed with the status {}: {}".format(response.status_code, response.content[:100]))
+        return None
+
+    try:
+        db_response = json.loads(response.content)
+    except ValueError:
+        print("Warning: cannot parse the response: {}".format(response.content[:100]))
+        return None
+
+    if not isinstance(db_response, dict) or "error" in db_response:
+        print("Warning: the query failed: {}".format(response.content[:100]))
+        return None
+
+    return compact_db_response(db_response)
+
+
+def compact_db_response(db_response):
+    """ Keeps only the number of hits and the compact hits of a parsed DQL response. """
+
+    compact = {}
+    if "hits" in db_response:
+        compact["hits"] = db_response["hits"]
+    if "data" in db_response:
+        compact["data"] = [compact_hit(hit) for hit in db_response["data"]]
+
+    return compact
 
 
 class CachedQuery(object):
-    def __init__(self, cache_fpath=CACHED_QUERY_DB):
-        self._cache = SqliteDict(cache_fpath, autocommit=True)
+    def __init__(self, cache_fpath=CACHED_QUERY_DB, memory_bytes=CACHED_QUERY_MEMORY_BYTES):
+        self._cache = get_shared_cache(cache_fpath, memory_bytes)
         
     def __del__(self):
         try:
             self._cache.close()
         except:
             print("Warning: trying to close a closed cache.")
-            
+
+    def _from_cache(self, key, value):
+        """ The entries of the old cache format (raw responses) are converted on the fly.
+        The failed requests cached by the old versions (raw error responses or empty
+        dictionaries) are treated as not cached. """
+
+        if not isinstance(value, dict):
+            value = compact_response(value)
+            if value is not None:
+                self._cache[key] = value
+
+        return value if value else None
+
+    def _get_cached(self, key):
+        """ Returns the cached compact response or None if the key is not cached. """
+
+        value = self._cache.get(key)
+        return None if value is None else self._from_cache(key, value)
+
+    def _get_cached_many(self, keys):
+        """ Returns a dictionary with the cached compact responses of the found keys. """
+
+        found = {}
+        for key, value in self._cache.get_many(keys).items():
+            value = self._from_cache(key, value)
+            if value is not None: found[key] = value
+
+        return found
+
     def make_query(self, query):
-        if query in self._cache:
-            return self._cache[query]
-        else:
-            response = make_query(query)
-            self._cache[query] = response
-            return response
-        
+        """ Returns the response to the query as a compact dictionary.
+        Raises QueryFailed if the query has no valid response. """
+
+        db_response = self._get_cached(query)
+        if db_response is None:
+            db_response = compact_response(make_query(query))
+            if db_response is None:
+                raise QueryFailed(query)
+            self._cache[query] = db_response
+
+        return db_response
+
+    def make_queries(self, queries, parallel=32):
+        """ Answers a batch of queries: the cache hits are looked up first and the
+        misses are sent concurrently using at most 'parallel' connections.
+        Returns a dictionary query -> response (failed queries are absent). """
+
+        queries = list(dict.fromkeys(queries))
+        responses = self._get_cached_many(queries)
+        missing = [query for query in queries if query not in responses]
+
+        if len(missing) == 0:
+            return responses
+
+        for query, response in zip(missing, make_queries(missing, parallel)):
+            db_response = compact_response(response)
+            if db_response is None:
+                print("Warning: query '{}' failed.".format(query))
+                continue
+            self._cache[query] = db_response
+            responses[query] = db_response
+
+        return responses
+
+    def make_types_query(self, entity_types, name):
+        """ Returns a dictionary entity type -> the response of the 'type:X name:"..."' query
+        of the type (see make_types_queries). Raises QueryFailed if a type can not be queried. """
+
+        type2response = self.make_types_queries(entity_types, [name], parallel=1)
+        if name not in type2response:
+            raise QueryFailed(types_name_query(entity_types, name))
+
+        return type2response[name]
+
+    def make_types_queries(self, entity_types, names, parallel=32):
+        """ Answers the 'type:X name:"..."' queries of the types for each name and caches them
+        by these queries. The types of a name that are not cached are queried at once by a
+        types_name_query of at most DQL_TYPES_QUERY_PAGES pages, the types which have less
+        than DQL_PAGE_SIZE hits in these pages (and not all the hits are read) are queried
+        one by one. The queries are sent concurrently using at most 'parallel' connections.
+        Returns a dictionary name -> entity type -> response (failed names are absent). """
+
+        names = list(dict.fromkeys(names))
+        cached = self._get_cached_many([type_name_query(t, name) for name in names for t in entity_types])
+        name2responses = {name: {} for name in names}
+        name2types = {}
+        for name in names:
+            for entity_type in entity_types:
+                query = type_name_query(entity_type, name)
+                if query in cached: name2responses[name][entity_type] = cached[query]
+                else: name2types.setdefault(name, []).append(entity_type)
+
+        # the types query is worth sending for two types or more
+        name2pages = {name: {"data": []} for name in name2types if len(name2types[name]) > 1}
+        for page_num in range(DQL_TYPES_QUERY_PAGES):
+            if len(name2pages) == 0: break
+
+            pending = list(name2pages)
+            queries = [types_name_query(name2types[name], name) for name in pending]
+            sizes = [DQL_PAGE_SIZE * len(name2types[name]) for name in pending]
+            offsets = [len(name2pages[name]["data"]) for name in pending]
+
+            for name, query, response in zip(pending, queries, make_queries(queries, parallel, sizes, offsets)):
+                page = compact_response(response)
+                if page is None:
+                    print("Warning: query '{}' failed.".format(query))
+                    del name2pages[name]
+                elif add_types_page(name2pages[name], page, name2types[name]):
+                    self._add_types_pages(name, name2pages.pop(name), name2types, name2responses)
+
+        for name in name2pages:
+            self._add_types_pages(name, name2pages[name], name2types, name2responses)
+
+        # the rest of the types are queried one by one
+        queries = [type_name_query(t, name) for name in name2types for t in name2types[name]]
+        query2response = self.make_queries(queries, parallel)
+        for name in name2types:
+            for entity_type in name2types[name]:
+                query = type_name_query(entity_type, name)
+                if query in query2response: name2responses[name][entity_type] = query2response[query]
+
+        return {name: name2responses[name] for name in names if len(name2responses[name]) == len(entity_types)}
+
+    def _add_types_pages(self, name, pages, name2types, name2responses):
+        """ Caches the responses of the types that are answered by the pages of the
+        types query of the name. The other types of the name are left in name2types. """
+
+        type2response = split_types_pages(pages, name2types[name])
+        for entity_type, db_response in type2response.items():
+            self._cache[type_name_query(entity_type, name)] = db_response
+            name2responses[name][entity_type] = db_response
+
+        name2types[name] = [t for t in name2types[name] if t not in type2response]
+        if len(name2types[name]) == 0: del name2types[name]
+
     def close(self):
         self._cache.close()
 
+    def cache_stats(self):
+        """ Hit/miss counters of the in-memory cache tier. """
+
+        return self._cache.stats()
+
     def response2dict(self, response):
-        return json.loads(response.content)
+        return compact_response(response)
 
     def get_entity(self, db_uri):
-        if db_uri in self._cache:
-            return self._cache[db_uri]
-        else:
-            response = self._get_entity(db_uri)
-            self._cache[db_uri] = response
-            return response
+        """ Returns the response with the entity of the URI. Raises QueryFailed
+        if the entity can not be fetched. """
+
+        db_response = self._get_cached(db_uri)
+        if db_response is None:
+            db_response = self._get_entity(db_uri)
+            if db_response is None:
+                raise QueryFailed(db_uri)
+            self._cache[db_uri] = db_response
+
+        return db_response
 
     def _get_entity(self, db_uri):
         """ Takes as input URI like http://www.diffbot.com/entity/CQSNBJBdRL7 and returns
-        and entity. """
+        and entity or None if the request failed. """
 
         db_uri = db_uri.replace("https:", "http:")
 
@@ -70,7 +285,7 @@ class CachedQuery(object):
             "query": "diffbotUri:{}".format(db_uri),
             "type": "query"}
 
-        r = requests.get(endpoint_diffbot, params=data)
+        r = http_client.get(endpoint_diffbot, params=data)
 
         return self.response2dict(r)
 
@@ -90,25 +305,128 @@ def get_token():
             return token
 
 
-def make_queries(queries, parallel=32):    
-    rs = []
-    for query in queries:
-        data = {
-            "token": get_token(),
-            "query": query,
-            "type": "query"}
+def type_name_query(entity_type, name):
+    """ The DQL query for the entities of the type with the name: also the cache key of its response. """
+
+    return 'type:{} name:"{}"'.format(entity_type, name)
+
+
+def types_name_query(entity_types, name):
+    """ A single DQL query for the entities of any of the given types with the name:
+    replaces one 'type:X name:"..."' query per entity type. """
+
+    types = ", ".join("type:{}".format(entity_type) for entity_type in entity_types)
+    return 'or({}) name:"{}"'.format(types, name)
+
+
+def split_hits_by_type(db_response, entity_types):
+    """ Splits the hits of a types_name_query response back by the entity types:
+    returns a dictionary entity type -> list of hits, where the hits of each type
+    are those that the 'type:X name:"..."' query would return. """
+
+    type2hits = {entity_type: [] for entity_type in entity_types}
+    if "data" not in db_response:
+        return type2hits
+
+    for hit in db_response["data"]:
+        hit_types = hit["types"] if "types" in hit else []
+        for entity_type in entity_types:
+            if entity_type in hit_types and len(type2hits[entity_type]) < DQL_PAGE_SIZE:
+                type2hits[entity_type].append(hit)
+
+    return type2hits
+
+
+def add_types_page(pages, page, entity_types):
+    """ Adds a page of a types_name_query response to the hits read so far. Returns True
+    if all the hits are read or each type has at least DQL_PAGE_SIZE hits. """
+
+    page_data = page["data"] if "data" in page else []
+    pages["data"] += page_data
+    pages["all_read"] = len(page_data) == 0 or len(pages["data"]) >= page.get("hits", 0)
+
+    if pages["all_read"]:
+        return True
+
+    type2hits = split_hits_by_type(pages, entity_types)
+    return all(len(type2hits[entity_type]) >= DQL_PAGE_SIZE for entity_type in entity_types)
+
+
+def split_types_pages(pages, entity_types):
+    """ Returns a dictionary entity type -> the response of its 'type:X name:"..."' query for the
+    types that are answered by the pages of a types query: all the hits are read or the type
+    has DQL_PAGE_SIZE hits. The number of the hits is known only if all the hits are read. """
 
-        rs.append(grequests.get(endpoint_diffbot, params=data))
-    
-    return grequests.map(rs, size=parallel)
+    type2response = {}
+    for entity_type, hits in split_hits_by_type(pages, entity_types).items():
+        if pages.get("all_read", False):
+            type2response[entity_type] = {"hits": len(hits), "data": hits}
+        elif len(hits) >= DQL_PAGE_SIZE:
+            type2response[entity_type] = {"data": hits}
 
+    return type2response
 
-def make_query(query):
-    data = {
+
+def query_params(query, size=None, offset=0):
+    params = {
         "token": get_token(),
         "query": query,
         "type": "query"}
-    r = requests.get(endpoint_diffbot, params=data)
+    if size is not None: params["size"] = size
+    if offset: params["from"] = offset
+
+    return params
+
+
+_query_pool = None
+_query_pool_lock = Lock()
+
+
+def get_query_pool():
+    """ The threads sending the batches of queries: they are shared by all the batches
+    of the process and use the keep-alive connections of http_client. """
+
+    global _query_pool
+    with _query_pool_lock:
+        if _query_pool is None:
+            _query_pool = ThreadPoolExecutor(max_workers=http_client.MAX_CONCURRENT_PER_HOST,
+                                             thread_name_prefix="diffbot")
+    return _query_pool
+
+
+def _get_or_none(params):
+    try:
+        return http_client.get(endpoint_diffbot, params=params)
+    except RequestException:
+        return None
+
+
+def make_queries(queries, parallel=32, sizes=None, offsets=None):
+    """ Sends the queries concurrently, at most 'parallel' at a time (and at most
+    MAX_CONCURRENT_PER_HOST of all the threads of the process, see http_client).
+    :param sizes, offsets the size and from parameters of each query (see query_params)
+    Returns the responses in the order of the queries, None for the failed requests. """
+
+    pool = get_query_pool()
+    rs = [None] * len(queries)
+    future2index = {}
+    for i, query in enumerate(queries):
+        if len(future2index) >= parallel:
+            done, _ = wait(future2index, return_when=FIRST_COMPLETED)
+            for future in done: rs[future2index.pop(future)] = future.result()
+
+        data = query_params(query, sizes[i] if sizes else None, offsets[i] if offsets else 0)
+        future2index[pool.submit(_get_or_none, data)] = i
+
+    for future in list(future2index):
+        rs[future2index.pop(future)] = future.result()
+
+    return rs
+
+
+def make_query(query, size=None, offset=0):
+    data = query_params(query, size, offset)
+    r = http_client.get(endpoint_diffbot, params=data)
 
     return r 
 
@@ -124,6 +442,24 @@ def query_and_save(query, output_fpath):
     save2json(output_fpath, r)
 
 
+def migrate_cache(cache_fpath=CACHED_QUERY_DB, batch_size=10000):
+    """ Converts a cache with pickled raw responses to the compact format in place. """
+
+    tic = time()
+    tmp_fpath = cache_fpath + ".migrating"
+    num = 0
 
+    with SqliteDict(cache_fpath, flag="r") as cache, SqliteDict(tmp_fpath, flag="n") as compact_cache:
+        for key, value in cache.iteritems():
+            value = compact_db_response(value) if isinstance(value, dict) else compact_response(value)
+            if value:  # the failed requests are not migrated, they are queried again
+                compact_cache[key] = value
 
+            num += 1
+            if num % batch_size == 0:
+                compact_cache.commit()
+                print("Migrated {} entries".format(num))
+        compact_cache.commit()
 
+    replace(tmp_fpath, cache_fpath)
+    print("Migrated {} entries of {} in {:.2f} sec.".format(num, cache_fpath, time() - tic))
@@ -0,0 +1,64 @@
+from threading import Lock, BoundedSemaphore
+from urllib.parse import urlsplit
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+POOL_CONNECTIONS = 10  # the number of the connection pools kept by a session
+TIMEOUT = (5, 60)  # the connect and read timeouts in seconds
+RETRIES = 3
+BACKOFF_FACTOR = 0.5  # the retries wait 0.5, 1, 2, ... seconds (or as long as Retry-After says)
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_CONCURRENT_PER_HOST = 32
+POOL_SIZE = MAX_CONCURRENT_PER_HOST  # the number of the keep-alive connections to a host
+
+_sessions = {}
+_semaphores = {}
+_lock = Lock()
+
+
+def _host(url):
+    parts = urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc)
+
+
+def get_session(url):
+    """ Returns the process-wide session of the host of the url: its connections are
+    kept alive and reused by the requests of all the threads to the host (the session
+    is not modified after it is created, and its connection pool is thread-safe). The
+    failed connections and the responses with the RETRY_STATUSES are retried with an
+    exponential backoff. """
+
+    host = _host(url)
+    with _lock:
+        if host not in _sessions:
+            retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                          status_forcelist=RETRY_STATUSES, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_SIZE,
+                                  max_retries=retry)
+            session = Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+            _semaphores[host] = BoundedSemaphore(MAX_CONCURRENT_PER_HOST)
+
+    return _sessions[host]
+
+
+def request(method, url, **kwargs):
+    """ Sends a request by the session of the host: at most MAX_CONCURRENT_PER_HOST
+    requests of all the threads are sent to a host at the same time, the others wait. """
+
+    session = get_session(url)
+    kwargs.setdefault("timeout", TIMEOUT)
+    with _semaphores[_host(url)]:
+        return session.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
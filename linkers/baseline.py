@@ -1,19 +1,24 @@
 from converter import URIConverter
-import json
 from utils import truncated_log, overlap
 from candidate import Candidate
 from diffbot_api import CachedQuery, EL_POL_ENTITY_TYPES
-from ttl import parse_d2kb_ttl, CLASS_URI, LINK_URI, NONE_URI
-from rdflib import URIRef
+from ttl import parse_d2kb_input, add_links, NONE_URI
 from random import random
 
 
 class TTLinker(object):
-    def link_ttl(self, input_ttl):
-        """ :param input_ttl a string with turtle (TTL) triples in the NIF format by GERBIL """
+    def link_ttl(self, input_ttl, params=None):
+        """ :param input_ttl a string with turtle (TTL) triples in the NIF format by GERBIL
+        :param params a dictionary with the parameters of this call (see link) """
 
-        graph, contexts, phrases = parse_d2kb_ttl(input_ttl)
-        input_len = len(graph)
+        output_ttl, contexts, phrases = self.link_ttl_phrases(input_ttl, params)
+        return output_ttl
+
+    def link_ttl_phrases(self, input_ttl, params=None):
+        """ Same as link_ttl, but returns also the contexts and the phrases parsed
+        from the input, e.g. to archive them without parsing the input again. """
+
+        graph, contexts, phrases = parse_d2kb_input(input_ttl)
 
         if len(contexts) > 1:
             print("Warning: more than one context is found. Using the first one.")
@@ -25,33 +30,39 @@ class TTLinker(object):
             # only one context
             context = contexts[0]
 
-        results = self.link(context, phrases)
+        results = self.link(context, phrases, params)
+        links = []
         for phrase, candidate in results:
             if candidate and candidate.link and candidate.link != "":
-                graph.add( (phrase.subj, LINK_URI, URIRef(candidate.link)) )
-                graph.add( (phrase.subj, CLASS_URI, URIRef(candidate.link)) )
+                links.append( (phrase.subj, candidate.link) )
             else:
                 print("Warning: can't link phrase '{}'@({}-{}): text='{}', uris='{}'".format(
                     phrase.text, phrase.beg, phrase.end, candidate.text, "; ".join(candidate.uris)))
                 print("".format(candidate))
-                graph.add( (phrase.subj, LINK_URI, NONE_URI) )
-                graph.add( (phrase.subj, CLASS_URI, NONE_URI) )
+                links.append( (phrase.subj, NONE_URI) )
 
-        print("# triples input:", input_len)
-        print("# triples output:", len(graph))
-        output_ttl = str(graph.serialize(format='n3', encoding="utf-8"), "utf-8")
+        print("# phrases linked:", len(links))
+        output_ttl = add_links(input_ttl, graph, links)
         
-        return output_ttl
+        return output_ttl, contexts, phrases
+
+    def link_many(self, documents, params=None):
+        """ Links the phrases of several documents, e.g. of a whole corpus.
+        :param documents a list of (context, phrases) pairs
+        :return a list with the linked phrases of each document (see link) """
+
+        return [self.link(context, phrases, params) for context, phrases in documents]
 
 
 class BaselineLinker(TTLinker):
-    def __init__(self, use_overlap=True, use_importance=True, verbose=True, lower=True):
+    def __init__(self, use_overlap=True, use_importance=True, verbose=True, lower=True, parallel=32):
         self._cq = CachedQuery()
         self._conv = URIConverter()
         self._use_overlap = use_overlap
         self._use_importance = use_importance
         self._verbose = verbose
         self._lower = lower
+        self._parallel = parallel
 
     def __del__(self):
         self.close()
@@ -148,14 +159,16 @@ class BaselineLinker(TTLinker):
 
         return sorted(candidates, reverse=True)
 
-    def link(self, context, phrases):
+    def link(self, context, phrases, params=None):
+        # retrieve the candidates of all the phrases in one batch
+        responses = self._cq.make_types_queries(EL_POL_ENTITY_TYPES, [phrase.text for phrase in phrases], self._parallel)
+
         linked_phrases = []
         for phrase in phrases:
             candidates = []
-            for entity_type in EL_POL_ENTITY_TYPES:
-                r = self._cq.make_query('type:{} name:"{}"'.format(entity_type, phrase.text))
-                db_response = json.loads(r.content)
-                candidates += self._link_db_query(phrase.text, db_response) 
+            if phrase.text in responses:
+                for entity_type in EL_POL_ENTITY_TYPES:
+                    candidates += self._link_db_query(phrase.text, responses[phrase.text][entity_type])
             candidates = set(candidates)
 
             if len(candidates) > 0:
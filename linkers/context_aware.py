@@ -1,20 +1,43 @@
 from linkers.baseline import BaselineLinker
 from collections import defaultdict
-from diffbot_api import EL_POL_ENTITY_TYPES
-import json
+from diffbot_api import EL_POL_ENTITY_TYPES, RELATED_FIELDS
 from candidate import Candidate
 from langid import classify
 import re
 from tqdm import tqdm
 from traceback import format_exc
 from patterns import re_newlines
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, join
+from os import fsync
+import pickle
+from utils import ROOT_DIR
+from cache import get_shared_cache
 
 
-# ALL_RELATED_FIELDS = ["founders", "categories", "ceo", "isPartOf",
-#                        "skills", "parents", "children", "parentCompany"]
-RELATED_FIELDS = ["founders", "ceo", "parentCompany", "isPartOf"]
 DEFAULT_IMPORTANCE = 1.0
 DEFAULT_DB_URI = ""
+CACHED_LANGID_DB = join(join(ROOT_DIR, "cache"), "langid-cache.sqlite")
+CACHED_LANGID_MEMORY_BYTES = 8 * 1024 * 1024
+ASCII_IS_ENGLISH = True  # names in pure ASCII are not classified by langid
+HARVEST_JOBS = 16  # concurrent Diffbot queries while harvesting the candidates
+HARVEST_CHUNK_SIZE = 1000  # the harvested chunk is appended to the checkpoint
+
+
+def add_phrase_candidates(phrase2candidates, phrase, candidates):
+    if len(candidates) > 0: phrase2candidates[phrase].update(candidates)
+
+
+def add_related_candidates(phrase2candidates, related_entity_id, candidates):
+    for related_c in candidates:
+        phrase2candidates[related_entity_id].add(related_c)
+        if related_c.db_uri != related_entity_id:
+            phrase2candidates[related_c.db_uri].add(related_c)
+
+
+# the kinds of the harvested keys -> the set of the done keys in the checkpoint, the function adding their candidates
+HARVEST_KINDS = {"phrases": ("done_phrases", add_phrase_candidates),
+                 "related": ("done_related", add_related_candidates)}
 
 
 class ContextAwareLinker(BaselineLinker):
@@ -24,7 +47,16 @@ class ContextAwareLinker(BaselineLinker):
         BaselineLinker.__init__(self)
         self._re_contains_alpha = re.compile(r"[a-z]+", re.U|re.I)
         self._re_newlines = re.compile(r"[\n\r]+")
+        self._re_ascii = re.compile(r"^[\x00-\x7f]*$")
         self._sep = " . "
+        self._lang_cache = get_shared_cache(CACHED_LANGID_DB, CACHED_LANGID_MEMORY_BYTES)
+
+    def close(self):
+        BaselineLinker.close(self)
+        try:
+            self._lang_cache.close()
+        except:
+            print("Warning: trying to close a closed object.")
 
     def _build_index2candidate(self, candidate2index):
         """ Constructs an index in the opposite direction. """
@@ -44,22 +76,47 @@ class ContextAwareLinker(BaselineLinker):
         raise NotImplementedError 
         return {}
 
+    def _classify_languages(self, texts):
+        """ Returns a dictionary with the languages of the texts. The texts in pure ASCII
+        are taken as English if ASCII_IS_ENGLISH, the others are classified by langid
+        once: the languages are kept in a persistent cache. """
+
+        text2lang = {}
+        unknown = []
+        for text in texts:
+            if text in text2lang: continue
+            if ASCII_IS_ENGLISH and self._re_ascii.match(text):
+                text2lang[text] = "en"
+            else:
+                text2lang[text] = None
+                unknown.append(text)
+
+        if len(unknown) == 0:
+            return text2lang
+
+        text2lang.update(self._lang_cache.get_many(unknown))
+        for text in unknown:
+            if text2lang[text] is None:
+                lang, conf = classify(text)
+                text2lang[text] = lang
+                self._lang_cache[text] = lang
+
+        return text2lang
+
     def _is_english(self, text):
-        lang, conf = classify(text)
-        return lang == "en"
+        return self._classify_languages([text])[text] == "en"
 
     def _is_alpha(self, text):
         return self._re_contains_alpha.search(text)
     
     def _get_en_names(self, hit):
-        names = []
-        
-        if "allNames" in hit:
-            for name in hit["allNames"]:
-                if self._is_alpha(name) and self._is_english(name):                    
-                    names.append(name)
-        
-        return names 
+        if "allNames" not in hit:
+            return []
+
+        names = [name for name in hit["allNames"] if self._is_alpha(name)]
+        name2lang = self._classify_languages(names)
+
+        return [name for name in names if name2lang[name] == "en"]
     
     def _get_name(self, hit):
         if "name" in hit:
@@ -125,49 +182,125 @@ class ContextAwareLinker(BaselineLinker):
 
         return relations
 
-    def get_phrase_candidates(self, phrases, related_entities=False):
-        phrase2candidates = defaultdict(set)  
-
-        for phrase in tqdm(phrases):
-            for entity_type in EL_POL_ENTITY_TYPES:
+    def _harvest_phrase(self, phrase):
+        """ Returns the candidates of a phrase or None if the phrase can not be queried. """
+
+        try:
+            type2response = self._cq.make_types_query(EL_POL_ENTITY_TYPES, phrase.text)
+        except:
+            print("Warning: cannot query phrase '{}'".format(phrase.text))
+            print(format_exc())
+            return None
+
+        candidates = []
+        for entity_type in EL_POL_ENTITY_TYPES:
+            try:
+                for hit in type2response[entity_type].get("data", []):
+                    candidates.append(self._build_candidate(hit))
+            except:
+                print("Warning: cannot process phrase '{}' of type '{}'".format(phrase.text, entity_type))
+                print(format_exc())
+
+        return candidates
+
+    def _harvest_related_entity(self, related_entity_id):
+        """ Returns the candidates of a related entity or None if it can not be fetched. """
+
+        try:
+            related_response = self._cq.get_entity(related_entity_id)
+            if "data" not in related_response or len(related_response["data"]) == 0:
+                print("Warning: can't find related entity: {}.".format(related_entity_id))
+                return []
+
+            return [self._build_candidate(related_hit) for related_hit in related_response["data"]]
+        except:
+            print("Warning: cannot fetch related entity '{}'".format(related_entity_id))
+            print(format_exc())
+            return None
+
+    def _load_harvest_checkpoint(self, checkpoint_fpath):
+        """ The checkpoint is a sequence of the pickled chunks of (key, candidates) pairs:
+        they are added again to the candidates. A chunk cut by an interruption is dropped. """
+
+        checkpoint = {"phrase2candidates": defaultdict(set), "done_phrases": set(), "done_related": set()}
+        if not checkpoint_fpath or not exists(checkpoint_fpath): return checkpoint
+
+        with open(checkpoint_fpath, "r+b") as checkpoint_f:
+            offset = 0
+            while True:
                 try:
-                    response_raw = self._cq.make_query('type:{} name:"{}"'.format(entity_type, phrase.text))
-                    response = json.loads(response_raw.content)
-
-                    if "data" not in response: continue
-                    else: data = response["data"]
-
-                    for hit in data:
-                        c = self._build_candidate(hit)
-                        phrase2candidates[phrase].add(c)
-
-                        if not related_entities: continue
-
-                        related_num = 0
-                        for relation_type in c.relations:
-                            for related_entity_id in c.relations[relation_type]:
-                                related_response = self._cq.get_entity(related_entity_id)
-
-                                if "data" not in related_response or len(related_response["data"]) == 0:
-                                    print("Warning: can't find related entity: {}.".format(related_entity_id))
-                                    continue
-
-                                for related_hit in related_response["data"]:
-                                    related_num += 1
-                                    related_c = self._build_candidate(related_hit)
-                                    phrase2candidates[related_entity_id].add(related_c)
-                                    if related_c.db_uri != related_entity_id:
-                                        phrase2candidates[related_c.db_uri].add(related_c)
-
-                                    print("'{}'#{}: added entity {} which is '{}' to {}".format(
-                                        phrase.text,
-                                        related_num,
-                                        c.db_uri,
-                                        relation_type,
-                                        related_entity_id))
+                    kind, harvested = pickle.load(checkpoint_f)
+                    done_keys, add_candidates = HARVEST_KINDS[kind]
+                except EOFError:
+                    break
                 except:
-                    print("Warning: cannot process phrase '{}' of type '{}'".format(phrase.text, entity_type))
-                    print(format_exc())
+                    print("Warning: dropping a broken chunk of the checkpoint at the byte {}: {}".format(
+                        offset, checkpoint_fpath))
+                    break
+
+                for key, candidates in harvested:
+                    add_candidates(checkpoint["phrase2candidates"], key, candidates)
+                    checkpoint[done_keys].add(key)
+                offset = checkpoint_f.tell()
+
+            checkpoint_f.truncate(offset)
+
+        print("Resuming the harvest of {} phrases and {} related entities: {}".format(
+            len(checkpoint["done_phrases"]), len(checkpoint["done_related"]), checkpoint_fpath))
+        return checkpoint
+
+    def _append_harvest_checkpoint(self, checkpoint_fpath, kind, harvested):
+        if not checkpoint_fpath or len(harvested) == 0: return
+
+        with open(checkpoint_fpath, "ab") as checkpoint_f:
+            pickle.dump((kind, harvested), checkpoint_f, protocol=pickle.HIGHEST_PROTOCOL)
+            checkpoint_f.flush()
+            fsync(checkpoint_f.fileno())
+
+    def _harvest(self, keys, harvest_key, kind, checkpoint, checkpoint_fpath, n_jobs):
+        """ Harvests the keys of a kind (see HARVEST_KINDS) in chunks by a pool of n_jobs
+        threads, each chunk is appended to the checkpoint. The keys that failed are
+        retried by the next harvest. """
+
+        done_keys, add_candidates = HARVEST_KINDS[kind]
+        done_keys = checkpoint[done_keys]
+        keys = [key for key in keys if key not in done_keys]
+        if len(keys) == 0: return
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool, tqdm(total=len(keys)) as progress:
+            for i in range(0, len(keys), HARVEST_CHUNK_SIZE):
+                chunk = keys[i:i + HARVEST_CHUNK_SIZE]
+                harvested = []
+                for key, candidates in zip(chunk, pool.map(harvest_key, chunk)):
+                    if candidates is None: continue
+                    add_candidates(checkpoint["phrase2candidates"], key, candidates)
+                    done_keys.add(key)
+                    harvested.append((key, candidates))
+                progress.update(len(chunk))
+                self._append_harvest_checkpoint(checkpoint_fpath, kind, harvested)
+
+    def get_phrase_candidates(self, phrases, related_entities=False, checkpoint_fpath=None, n_jobs=HARVEST_JOBS):
+        """ Retrieves the candidates of the phrases and, optionally, of the entities related
+        to them by a pool of n_jobs threads. The related entities are fetched once for all
+        the phrases. If checkpoint_fpath is given, the progress is saved to this file and
+        an interrupted harvest is resumed from it. """
+
+        checkpoint = self._load_harvest_checkpoint(checkpoint_fpath)
+        phrase2candidates = checkpoint["phrase2candidates"]
+
+        print("Harvesting the candidates of {} phrases".format(len(phrases)))
+        self._harvest(phrases, self._harvest_phrase, "phrases", checkpoint, checkpoint_fpath, n_jobs)
+
+        if related_entities:
+            related_entity_ids = set()
+            for phrase in checkpoint["done_phrases"]:
+                for c in phrase2candidates[phrase]:
+                    for relation_type in c.relations:
+                        related_entity_ids.update(c.relations[relation_type])
+
+            print("Harvesting {} related entities".format(len(related_entity_ids)))
+            self._harvest(sorted(related_entity_ids), self._harvest_related_entity, "related",
+                          checkpoint, checkpoint_fpath, n_jobs)
 
         return phrase2candidates
 
@@ -1,7 +1,7 @@
 from linkers.sparse import SparseLinker
+from linkers.baseline import TTLinker
 from traceback import format_exc
-from gensim.models import KeyedVectors
-from utils import overlap
+from utils import overlap_many
 from candidate import Candidate
 from time import time
 from traceback import format_exc
@@ -12,7 +12,77 @@ from sklearn.externals import joblib
 from sklearn.preprocessing import normalize
 from tqdm import tqdm
 from candidate import make_phrases
-from numpy import argsort, argmax, dot, zeros, multiply, ones
+from ann import IVFIndex, top_k
+from numpy import argmax, dot, zeros, multiply, ones, load, save, float32, float64, int64
+from numpy import vstack, repeat, tile, arange, array, asarray, diff
+from scipy.sparse import csr_matrix, save_npz, load_npz
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+
+class MappedWordVectors(object):
+    """ Normalised word vectors memory-mapped read-only from a .npy file: the processes
+    that use the same file share its pages instead of loading own copies. """
+
+    def __init__(self, vectors_fpath, vocab_fpath):
+        self.vectors = load(vectors_fpath, mmap_mode="r")
+        self.vector_size = self.vectors.shape[1]
+
+        # the words are separated by "\n" only: the line iteration of the text files
+        # splits also on "\x85", "\u2028" and the other unicode line breaks in the words
+        with open(vocab_fpath, "r", encoding="utf-8", newline="\n") as vocab_f:
+            words = vocab_f.read().split("\n")
+        if len(words) > 0 and words[-1] == "": words.pop()
+
+        assert len(words) == self.vectors.shape[0], "The vocabulary {} has {} words, the vectors {} have {} rows.".format(
+            vocab_fpath, len(words), vectors_fpath, self.vectors.shape[0])
+        self.vocab = {word: index for index, word in enumerate(words)}
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __getitem__(self, word):
+        return self.vectors[self.vocab[word]]
+
+    @staticmethod
+    def save(wv, vectors_fpath, vocab_fpath):
+        """ Saves the normalised vectors of gensim KeyedVectors. """
+
+        save(vectors_fpath, wv.vectors.astype(float32))
+        with open(vocab_fpath, "w", encoding="utf-8", newline="\n") as vocab_f:
+            for word in wv.index2word:
+                vocab_f.write("{}\n".format(word))
+
+
+def project(sparse_vectors, projection, target_groups):
+    """ Projects the rows of a sparse CSR matrix to the dense space: the word vectors
+    of the features weighted by the feature values and divided by the number of
+    non-zero features plus one (as the filtered features are counted too).
+    :param target_groups a list of the row indices and the features that are excluded from these rows """
+
+    dense_vectors = asarray(sparse_vectors.dot(projection).todense(), dtype=float64)
+
+    for rows, target_features in target_groups:
+        target_weights = sparse_vectors[rows][:, target_features]
+        dense_vectors[rows] -= asarray(target_weights.dot(projection[target_features]).todense())
+
+    features_num = diff(sparse_vectors.indptr)
+    dense_vectors /= (features_num + 1.)[:, None]
+
+    return dense_vectors
+
+
+_worker_projection = None
+
+
+def _init_projection_worker(projection):
+    global _worker_projection
+    _worker_projection = projection
+
+
+def _project_in_worker(args):
+    sparse_vectors, target_groups = args
+    return project(sparse_vectors, _worker_projection, target_groups)
 
 
 class DenseLinker(SparseLinker):
@@ -22,114 +92,167 @@ class DenseLinker(SparseLinker):
         self._wv = self._load_word_embbeddings(embeddings_fpath)
         self._stopwords = set(stopwords.words("english"))
 
+        if hasattr(self, '_vectorizer'):
+            self._projection = self._load_projection()
+
         if hasattr(self, '_dense_vectors'):
             print("Normalizing dense vectors...")
             tic = time()
             self._dense_vectors = normalize(self._dense_vectors)
             print("Done in {:.2f} sec.".format(time() - tic))
+            self._dense_index = self._load_dense_index()
         else:
             print("Warning: no dense vectors could be found. You need to train the model first.")
 
+    def _load_dense_index(self):
+        if not exists(self._dense_index_fpath):
+            return None
+
+        print("Loading:", self._dense_index_fpath)
+        try:
+            return IVFIndex.load(self._dense_index_fpath, self._dense_vectors)
+        except ValueError:
+            print("Warning: the index does not match the dense vectors. Rebuild it with build_dense_index.")
+            return None
+
+    def build_dense_index(self, n_lists=None, n_probe=8):
+        """ Builds and saves the approximate nearest neighbour index of the dense vectors. """
+
+        self._dense_index = IVFIndex(n_lists, n_probe).fit(self._dense_vectors)
+        self._dense_index.save(self._dense_index_fpath)
+        print("Dense index:", self._dense_index_fpath)
+
+    def most_similar(self, candidate_index, k=10, exact=False):
+        """ Returns a list of the k candidates most similar to the candidate with the index
+        (including itself) with their cosine similarities. Uses the approximate nearest
+        neighbour index unless it is not built or exact=True. """
+
+        vector = self._dense_vectors[candidate_index, :]
+
+        if self._dense_index is not None and not exact:
+            indices, sims = self._dense_index.search(vector, k)
+        else:
+            sims = self._dense_vectors.dot(vector)
+            indices = top_k(sims, k)
+            sims = sims[indices]
+
+        return [(self._get_candidate(index), sim) for index, sim in zip(indices, sims)]
+
     def print_most_similar(self, n=10, max_candidates=10, test_name="Seal"):
         test_phrases = make_phrases([test_name])
 
         for test_phrase in test_phrases:
             print("=" * 50, "\n", test_phrase)
-            test_candidates = self._phrase2candidates[self._default_phrase(test_phrase)]
+            test_candidates, test_indices = self._get_candidates(test_phrase)
 
-            for j, tc in enumerate(test_candidates):
+            for j, (tc, tc_index) in enumerate(zip(test_candidates, test_indices)):
                 if j > max_candidates: break
 
                 print("=" * 50, "\n", tc)
 
-                tc_index = self._candidate2index[tc]
-                tc_dvector = self._dense_vectors[tc_index, :]
-
-                # dot product with all candidates to find the most similar ones
-                tc_sims = self._dense_vectors.dot(tc_dvector)
-                tc_sorted_indices = argsort(-tc_sims)[:n]
-
                 print("-" * 50)
-                for i, nearest_candidate_index in enumerate(tc_sorted_indices):
-                    print(i, tc_sims[nearest_candidate_index], self._index2candidate[nearest_candidate_index], "\n")
+                for i, (nearest_candidate, sim) in enumerate(self.most_similar(tc_index, n)):
+                    print(i, sim, nearest_candidate, "\n")
 
     def _load(self, model_dir):
         SparseLinker._load(self, model_dir)
 
         dense_vectors_filename = "dense_vectors.pkl"
         self._dense_vectors_fpath = join(model_dir, dense_vectors_filename)
+        dense_index_filename = "dense_index.pkl"
+        self._dense_index_fpath = join(model_dir, dense_index_filename)
+        self._dense_index = None
+        projection_filename = "projection.npz"
+        self._projection_fpath = join(model_dir, projection_filename)
 
         if exists(self._dense_vectors_fpath):
             print("Loading:", self._dense_vectors_fpath)
             self._dense_vectors = joblib.load(self._dense_vectors_fpath)
 
-    def train(self, dataset_fpaths):
+    def train(self, dataset_fpaths, n_jobs=1, chunk_size=10000):
+        """ Builds the dense vectors of the candidates of the phrases in the datasets.
+        :param n_jobs the number of processes that compute the chunks of chunk_size rows """
+
+        tic = time()
         phrases = self._dataset2phrases(dataset_fpaths)
-        self._dense_vectors = zeros((self._vectors.shape[0], self._wv.vector_size))
 
+        # the target of each candidate row: the last phrase of the candidate
+        index2target = {}
         for phrase in tqdm(phrases):
             try:
                 dphrase = self._default_phrase(phrase)
-                if dphrase in self._phrase2candidates:
-                    # get the candidates
-                    candidates = list(self._phrase2candidates[dphrase])  # to remove
-                    indices = []
-                    for candidate in candidates:
-                        if candidate in self._candidate2index:
-                            indices.append(self._candidate2index[candidate])
-                        else:
-                            print("Warning: candidate '{}' is not indexed".format(candidate))
-                            indices.append(0)  # just to make sure lengths are equal
-
-                    #candidate_vectors = self._vectors[indices]
-                    print("Retrieved {} candidates for '{}'".format(len(indices), phrase.text))
-
-                    for index in indices:
-                        self._dense_vectors[index, :] = self._get_dense_vector(self._vectors[index, :], dphrase.text)
+                for index in self._get_candidate_indices(dphrase):
+                    index2target[int(index)] = dphrase.text
             except:
                 print("Warning: error phrase '{}'".format(phrase))
                 print(format_exc())
 
+        indices = sorted(index2target)
+        chunks = []
+        for i in range(0, len(indices), chunk_size):
+            chunk_indices = indices[i:i + chunk_size]
+            chunk_targets = [index2target[index] for index in chunk_indices]
+            chunks.append((chunk_indices, self._vectors[chunk_indices], self._get_target_groups(chunk_targets)))
+        print("Computing {} dense vectors in {} chunks...".format(len(indices), len(chunks)))
+
+        self._dense_vectors = zeros((self._vectors.shape[0], self._wv.vector_size))
+        if n_jobs > 1:
+            with ProcessPoolExecutor(n_jobs, initializer=_init_projection_worker,
+                                     initargs=(self._projection,)) as executor:
+                chunk_vectors = executor.map(_project_in_worker, [chunk[1:] for chunk in chunks])
+                for (chunk_indices, _, _), dense_vectors in zip(chunks, chunk_vectors):
+                    self._dense_vectors[chunk_indices, :] = dense_vectors
+        else:
+            for chunk_indices, sparse_vectors, target_groups in tqdm(chunks):
+                self._dense_vectors[chunk_indices, :] = project(sparse_vectors, self._projection, target_groups)
+
         joblib.dump(self._dense_vectors, self._dense_vectors_fpath)
         print("Dense vectors:", self._dense_vectors_fpath)
 
+        # as after loading the model
+        self._dense_vectors = normalize(self._dense_vectors)
+        self.build_dense_index()
+        print("Training is done in {:.2f} sec.".format(time() - tic))
+
     def _load_word_embbeddings(self, word_embeddings_fpath):
         print("Loading word vectors from:", word_embeddings_fpath)
         tic = time()
 
         self._params["word_embeddings_pickle"] = word_embeddings_fpath + ".pkl"
-        if exists(self._params["word_embeddings_pickle"]):
-            wv = KeyedVectors.load(self._params["word_embeddings_pickle"])
-            wv.init_sims(replace=True)
-        else:
-            wv = KeyedVectors.load_word2vec_format(word_embeddings_fpath, binary=False, unicode_errors="ignore")
+        self._params["word_embeddings_npy"] = word_embeddings_fpath + ".npy"
+        self._params["word_embeddings_vocab"] = word_embeddings_fpath + ".vocab.txt"
+
+        if not (exists(self._params["word_embeddings_npy"]) and exists(self._params["word_embeddings_vocab"])):
+            # the conversion is done once, then the vectors are memory-mapped without gensim
+            from gensim.models import KeyedVectors
+
+            if exists(self._params["word_embeddings_pickle"]):
+                wv = KeyedVectors.load(self._params["word_embeddings_pickle"])
+            else:
+                wv = KeyedVectors.load_word2vec_format(word_embeddings_fpath, binary=False, unicode_errors="ignore")
             wv.init_sims(replace=True)
 
             tac = time()
-            wv.save(self._params["word_embeddings_pickle"])
-            print("Saved in {} sec.".format(time() - tac))
+            MappedWordVectors.save(wv, self._params["word_embeddings_npy"], self._params["word_embeddings_vocab"])
+            print("Saved in {} sec.:".format(time() - tac), self._params["word_embeddings_npy"])
+            del wv
 
+        wv = MappedWordVectors(self._params["word_embeddings_npy"], self._params["word_embeddings_vocab"])
         print("Loaded in {} sec.".format(time() - tic))
 
         return wv
 
-    def link(self, context, phrases):
+    def link(self, context, phrases, params=None):
+        params = self._link_params(params)
         linked_phrases = []
         context_vector = self._vectorizer.transform([context])
 
         for phrase in phrases:
             try:
                 dphrase = self._default_phrase(phrase)
-                if dphrase in self._phrase2candidates:
+                if self._has_phrase(dphrase):
                     # get the candidates
-                    candidates = list(self._phrase2candidates[dphrase])  # to remove
-                    indices = []
-                    for candidate in candidates:
-                        if candidate in self._candidate2index:
-                            indices.append(self._candidate2index[candidate])
-                        else:
-                            print("Warning: candidate '{}' is not indexed".format(candidate))
-                            indices.append(0)  # just to make sure lengths are equal
+                    indices = self._get_candidate_indices(dphrase)
 
                     dense_candidate_vectors = self._dense_vectors[indices]
                     # check if candidates are correct
@@ -140,18 +263,15 @@ class DenseLinker(SparseLinker):
                     # rank the candidates
                     sims = dot(dense_candidate_vectors, dense_context_vector.T)
 
-                    if self._params["use_overlap"]:
-                        overlap_scores = zeros(sims.shape)
-                        for i, candidate in enumerate(candidates):
-                            overlap_scores[i] = overlap(candidate.name, phrase.text)
+                    if params["use_overlap"]:
+                        names = self._get_candidate_names(indices)
+                        overlap_scores = overlap_many(names, phrase.text).reshape(sims.shape)
                     else:
                         overlap_scores = ones(sims.shape)
 
                     scores = multiply(sims, overlap_scores)
                     best_index = argmax(scores)
-                    best_candidate = candidates[best_index]
-                    best_candidate.score = scores[best_index]
-                    best_candidate.link = self._get_dbpedia_uri(best_candidate.wiki, best_candidate.uris)
+                    best_candidate = self._link_candidate(indices[best_index], scores[best_index])
                     linked_phrases.append((phrase, best_candidate))
                 else:
                     print("Warning: phrase '{}' is not found in the vocabulary of the model".format(phrase))
@@ -163,44 +283,104 @@ class DenseLinker(SparseLinker):
                 linked_phrases.append((phrase, Candidate()))
         return linked_phrases
 
-    def _get_dense_vectors(self, sparse_vectors, target):
-        dense_vectors = zeros((sparse_vectors.shape[0], self._wv.vector_size))
+    def link_many(self, documents, params=None):
+        """ The dense vectors of the contexts depend on the target phrases,
+        so the documents are linked one by one. """
 
-        for i in range(sparse_vectors.shape[0]):
-            sparse_candidate_vector = sparse_vectors[i, :]
-            dense_candidate_vector = self._get_dense_vector(sparse_candidate_vector, target)
-            dense_vectors[i, :] = dense_candidate_vector
+        return TTLinker.link_many(self, documents, params)
 
-        return dense_vectors
+    def _is_content_word(self, word):
+        """ The words which vectors are used for the dense vectors: no stopwords,
+        only foreign words, adjectives, nouns, verbs and adverbs. """
 
-    def _get_dense_vector(self, sparse_vector, target):
-        """ Construct the dense vector """
+        if word.lower() in self._stopwords: return False
+        lemma, pos = pos_tag([word])[0]
+        return pos[:2] in ["FW", "JJ", "JJ", "NN", "VB", "RB"]
 
-        dense_vector = zeros(self._wv.vector_size)
-        weights_sum = 0.
-        names = self._vectorizer.get_feature_names()
+    def _build_projection(self):
+        """ Builds a sparse matrix that maps the features of the vectorizer to
+        the word vectors: the rows of the filtered or unknown words are empty. """
 
-        for i, word_weight in enumerate(sparse_vector.data):
-            feature_index = sparse_vector.indices[i]
-            word = names[feature_index]
+        names = self._vectorizer.get_feature_names()
+        feature_indices = []
+        word_vectors = []
 
-            if word.lower() in self._stopwords or word.lower() == target.lower(): continue
-            lemma, pos = pos_tag([word])[0]
-            if pos[:2] not in ["FW", "JJ", "JJ", "NN", "VB", "RB"]: continue
-            # print(word, end=", ")
+        for feature_index, word in enumerate(tqdm(names)):
+            if not self._is_content_word(word): continue
 
-            if word in self._wv.vocab:
-                word_vector = self._wv[word]
-            elif word.capitalize() in self._wv.vocab:
-                word_vector = self._wv[word.capitalize()]
+            if word in self._wv:
+                word_vectors.append(self._wv[word])
+            elif word.capitalize() in self._wv:
+                word_vectors.append(self._wv[word.capitalize()])
             else:
                 continue
+            feature_indices.append(feature_index)
 
+        dim = self._wv.vector_size
+        if len(word_vectors) > 0:
+            data = vstack(word_vectors).ravel()
+        else:
+            data = zeros(0, dtype=float32)
+        rows = repeat(array(feature_indices, dtype=int64), dim)
+        cols = tile(arange(dim), len(feature_indices))
 
-            dense_vector += word_weight * word_vector
-            weights_sum += word_weight
+        return csr_matrix((data, (rows, cols)), shape=(len(names), dim))
 
+    def _load_projection(self):
+        tic = time()
+
+        if exists(self._projection_fpath):
+            print("Loading:", self._projection_fpath)
+            projection = load_npz(self._projection_fpath)
+            if projection.shape == (len(self._vectorizer.vocabulary_), self._wv.vector_size):
+                print("Loaded in {:.2f} sec.".format(time() - tic))
+                return projection
+            print("Warning: the projection does not match the vectorizer or the embeddings.")
+
+        print("Building the projection of the features to the word vectors...")
+        projection = self._build_projection()
+        save_npz(self._projection_fpath, projection)
+        print("Saved in {:.2f} sec.:".format(time() - tic), self._projection_fpath)
+
+        return projection
+
+    def _get_target_features(self, target):
+        """ Indices of the features equal to the target phrase: these are excluded. """
+
+        if not hasattr(self, "_lower2features"):
+            lower2features = defaultdict(list)
+            for word, feature_index in self._vectorizer.vocabulary_.items():
+                lower2features[word.lower()].append(feature_index)
+            self._lower2features = lower2features
+
+        return self._lower2features.get(target.lower(), [])
+
+    def _get_target_groups(self, targets):
+        """ Groups the rows by their target phrase: returns a list of the row indices
+        and the indices of the features equal to the target. """
+
+        target2rows = defaultdict(list)
+        for row, target in enumerate(targets):
+            target2rows[target].append(row)
+
+        target_groups = []
+        for target, rows in target2rows.items():
+            target_features = self._get_target_features(target)
+            if len(target_features) > 0:
+                target_groups.append((rows, target_features))
+
+        return target_groups
+
+    def _get_dense_vectors(self, sparse_vectors, targets):
+        """ Constructs the dense vectors of the rows of a sparse CSR matrix.
+        :param targets the target phrase or a list of them, one per row """
+
+        if isinstance(targets, str):
+            targets = [targets] * sparse_vectors.shape[0]
+
+        return project(sparse_vectors, self._projection, self._get_target_groups(targets))
+
+    def _get_dense_vector(self, sparse_vector, target):
+        """ Construct the dense vector """
 
-        dense_vector = dense_vector / (len(sparse_vector.data) + 1.)
-        #print("\n>>>>>>>>\n")
-        return dense_vector
+        return self._get_dense_vectors(sparse_vector, target)[0]
@@ -8,7 +8,7 @@ class NNLinker(BaselineLinker):
         BaselineLinker.__init__(self)
         self.evaluator = Evaluator()
 
-    def link(self, context, phrases):
+    def link(self, context, phrases, params=None):
 
         linked_phrases = list()
 
@@ -29,7 +29,7 @@ class CandidateRandom(NNLinker):
     def __init__(self):
         NNLinker.__init__(self)
 
-    def link(self, context, phrases):
+    def link(self, context, phrases, params=None):
 
         linked_phrases = list()
 
@@ -0,0 +1,117 @@
+from threading import Lock
+from time import time
+import resource
+
+
+# dense_model_dir, embeddings_fpath = "data/count-stopwords-3", "data/wiki-news-300d-1M.vec"
+# dense_model_dir, embeddings_fpath = "data/count-stopwords-3-cc", "data/crawl-300d-2M.vec"
+dense_model_dir, embeddings_fpath = "data/count-stopwords-10", "data/crawl-300d-2M.vec"
+
+# sparse_model_dir = "data/all0"
+# sparse_model_dir = "data/tfidf-stopwords-2"
+# sparse_model_dir = "data/count-stopwords-3"
+sparse_model_dir = "data/count-stopwords-10"
+
+
+def get_memory_mb():
+    """ Returns the resident memory of the process in MB. """
+
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * resource.getpagesize() / 1024. / 1024.
+    except (IOError, OSError, IndexError, ValueError):
+        # peak memory in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class LinkerRegistry(object):
+    """ Builds the linkers on their first use and keeps them for the next calls. """
+
+    def __init__(self):
+        self._factories = {}
+        self._linkers = {}
+        self._stats = {}
+        self._locks = {}
+        self._lock = Lock()
+
+    def register(self, name, factory):
+        """ :param factory a function without arguments that builds the linker """
+
+        with self._lock:
+            self._factories[name] = factory
+            self._locks[name] = Lock()
+
+    def names(self):
+        return list(self._factories.keys())
+
+    def is_loaded(self, name):
+        return name in self._linkers
+
+    def get(self, name):
+        if name in self._linkers:
+            return self._linkers[name]
+
+        if name not in self._factories:
+            raise KeyError("Unknown linker: {}".format(name))
+
+        # concurrent requests to the same linker wait for a single build
+        with self._locks[name]:
+            if name not in self._linkers:
+                print("Loading linker:", name)
+                tic = time()
+                memory_before = get_memory_mb()
+                linker = self._factories[name]()
+                self._stats[name] = {"load_time": time() - tic,
+                                     "memory_mb": get_memory_mb() - memory_before}
+                self._linkers[name] = linker
+                print("Linker '{}' loaded in {:.2f} sec. using {:.0f} MB".format(
+                    name, self._stats[name]["load_time"], self._stats[name]["memory_mb"]))
+
+        return self._linkers[name]
+
+    def preload(self, names):
+        for name in names:
+            self.get(name)
+
+    def stats(self):
+        """ Returns the load time (sec.) and memory (MB) of the linkers. """
+
+        return {name: dict(loaded=self.is_loaded(name), **self._stats.get(name, {}))
+                for name in self._factories}
+
+
+def default_registry():
+    """ The linkers served by the NIF web services. """
+
+    # the modules of the linkers are imported on demand too
+    registry = LinkerRegistry()
+
+    def baseline(**kwargs):
+        def build():
+            from linkers.baseline import BaselineLinker
+            return BaselineLinker(**kwargs)
+        return build
+
+    def dense():
+        from linkers.dense import DenseLinker
+        return DenseLinker(dense_model_dir, embeddings_fpath)
+
+    def sparse():
+        from linkers.sparse import SparseLinker
+        return SparseLinker(sparse_model_dir)
+
+    def supertagger():
+        from linkers.supertagger import SuperTagger
+        return SuperTagger()
+
+    registry.register("overlap_importance", baseline(use_overlap=True, use_importance=True))
+    registry.register("importance", baseline(use_overlap=False, use_importance=True))
+    registry.register("overlap", baseline(use_overlap=True, use_importance=False, lower=True))
+    registry.register("overlap_case", baseline(use_overlap=True, use_importance=False, lower=False))
+    registry.register("random", baseline(use_overlap=False, use_importance=False))
+    registry.register("dense", dense)
+    registry.register("sparse", sparse)
+    registry.register("supertagger", supertagger)
+
+    return registry
@@ -1,22 +1,26 @@
 import numpy as np
-from utils import overlap
+from utils import overlap_many
 from linkers.context_aware import ContextAwareLinker 
 from candidate import Candidate
 from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from candidate import Phrase, make_phrases
+from candidate_store import CandidateStore
 from pandas import read_csv
 from time import time
 from os.path import join
 from utils import ensure_dir
 from sklearn.externals import joblib
 import json
-from os.path import exists
+from os.path import exists, isdir, basename
+from os import remove, rename, listdir
+from shutil import rmtree
 import codecs 
 from numpy import dot, argmax
 from traceback import format_exc
 
 
-# ToDo: save also directly the phrase2index file for faster classifications
+TRAINED_MARKER = "TRAINED"  # written to the staging directory when all the files of a training are saved
+
 
 class SparseLinker(ContextAwareLinker):
     def __init__(self, model_dir, tfidf=True, use_overlap=True, description="", stop_words=True,
@@ -42,6 +46,9 @@ class SparseLinker(ContextAwareLinker):
         phrase2candidates_filename = "phrase2candidates.pkl"
         phrases_filename = "phrases.txt"
         candidates_filename = "candidates.txt"
+        candidate_store_dirname = "candidates"
+        harvest_checkpoint_filename = "phrase2candidates.checkpoint.pkl"
+        staging_dirname = "training.tmp"
         
         self._vectorizer_fpath = join(model_dir, vectorizer_filename)
         self._candidate2index_fpath = join(model_dir, candidate2index_filename)
@@ -50,33 +57,74 @@ class SparseLinker(ContextAwareLinker):
         self._phrase2candidates_fpath = join(model_dir, phrase2candidates_filename)
         self._phrases_fpath = join(model_dir, phrases_filename)
         self._candidates_fpath = join(model_dir, candidates_filename)
+        self._candidate_store_dir = join(model_dir, candidate_store_dirname)
+        self._harvest_checkpoint_fpath = join(model_dir, harvest_checkpoint_filename)
+        self._model_dir = model_dir
+        self._staging_dir = join(model_dir, staging_dirname)
+        self._candidate_store = None
         self._load(model_dir) # using the defined paths
 
     def set_params(self, params):
+        """ Changes the parameters of the model. Not safe to call while other threads
+        are linking: pass the parameters to link instead. """
+
         for param in params:
             self._params[param] = params[param]
 
+    def _link_params(self, params):
+        """ Returns the parameters of a link call: the parameters of the model updated
+        with the call-specific ones. The model itself is not changed. """
+
+        if params is None or len(params) == 0:
+            return self._params
+
+        link_params = dict(self._params)
+        link_params.update(params)
+
+        return link_params
+
+    def _install_trained_model(self):
+        """ Moves the files of a training from the staging directory to the model directory
+        if all of them are saved and removes the harvest checkpoint. An installation that
+        was interrupted is completed by calling it again. Returns True if it is installed. """
+
+        if not exists(join(self._staging_dir, TRAINED_MARKER)):
+            return False
+
+        for filename in listdir(self._staging_dir):
+            if filename == TRAINED_MARKER: continue
+            model_fpath = join(self._model_dir, filename)
+            if isdir(model_fpath): rmtree(model_fpath)
+            elif exists(model_fpath): remove(model_fpath)
+            rename(join(self._staging_dir, filename), model_fpath)
+
+        if exists(self._harvest_checkpoint_fpath): remove(self._harvest_checkpoint_fpath)
+        rmtree(self._staging_dir)
+        print("Installed the trained model:", self._model_dir)
+        return True
+
     def _load(self, model_dir):
         tic = time()
         ensure_dir(model_dir) 
+        self._install_trained_model()
 
         if exists(self._params_fpath):
             with open(self._params_fpath, "r") as fp:
                 self._params = json.load(fp)
             print("Parameters:\n- ", "\n- ".join("{}: {}".format(p, self._params[p]) for p in self._params))
          
-        if exists(self._phrase2candidates_fpath):
+        if not CandidateStore.exists(self._candidate_store_dir) and \
+                exists(self._phrase2candidates_fpath) and exists(self._candidate2index_fpath):
+            # models trained before the candidate store: convert the pickles once
             print("Loading:", self._phrase2candidates_fpath)
-            self._phrase2candidates = joblib.load(self._phrase2candidates_fpath)
-        
-        if exists(self._candidate2index_fpath):
+            phrase2candidates = joblib.load(self._phrase2candidates_fpath)
             print("Loading:", self._candidate2index_fpath)
-            self._candidate2index = joblib.load(self._candidate2index_fpath)
+            candidate2index = joblib.load(self._candidate2index_fpath)
+            CandidateStore.save(self._candidate_store_dir, candidate2index, phrase2candidates)
 
-            print("Building index2candidate lookup table...")
-            tic = time()
-            self._index2candidate = self._build_index2candidate(self._candidate2index)
-            print("Done in {:.2f} sec.".format(time() - tic))
+        if CandidateStore.exists(self._candidate_store_dir):
+            print("Loading:", self._candidate_store_dir)
+            self._candidate_store = CandidateStore(self._candidate_store_dir)
 
         if exists(self._vectorizer_fpath):
             print("Loading:", self._vectorizer_fpath)
@@ -96,16 +144,27 @@ class SparseLinker(ContextAwareLinker):
         self._train(phrases)
         print("Training is done in {:.2f} sec.".format(time()-tic))
         
+    def _staged(self, fpath):
+        return join(self._staging_dir, basename(fpath))
+
     def _train(self, phrases):
+        # all the files are saved to the staging directory and replace the files of the
+        # old model only when the whole model is saved: an interrupted training keeps the
+        # old model and the checkpoint of the harvest
+        if exists(self._staging_dir): rmtree(self._staging_dir)
+        ensure_dir(self._staging_dir)
+
         # get the phrases
-        with codecs.open(self._phrases_fpath, "w", "utf-8") as out:
+        with codecs.open(self._staged(self._phrases_fpath), "w", "utf-8") as out:
             for phrase in phrases: out.write("{}\n".format(phrase.text))
-        print("Saved phrases:", self._phrases_fpath)                                      
+        print("Saved phrases:", self._staged(self._phrases_fpath))
                                       
         self._params["num_phrases"] = len(phrases)
         print("Number of phrases:", len(phrases))
         
-        self._phrase2candidates = self.get_phrase_candidates(phrases, self._params["related_entities"])
+        # an interrupted harvest of the candidates is resumed from the checkpoint
+        self._phrase2candidates = self.get_phrase_candidates(
+            phrases, self._params["related_entities"], self._harvest_checkpoint_fpath)
 
         # get candidates for the phrases
         candidates = set()
@@ -113,10 +172,9 @@ class SparseLinker(ContextAwareLinker):
             for candidate in self._phrase2candidates[phrase]:
                 candidates.add(candidate)
         print("Number of candidates:", len(candidates))
-        print("Saved phrase2candidate:", self._phrase2candidates_fpath)
 
         # save the vector indices for the candidates
-        with codecs.open(self._candidates_fpath, "w", "utf-8") as out:
+        with codecs.open(self._staged(self._candidates_fpath), "w", "utf-8") as out:
             self._candidate2index = {}
             corpus = []
             for index, candidate in enumerate(candidates):
@@ -146,10 +204,10 @@ class SparseLinker(ContextAwareLinker):
 
                 corpus.append(" ".join(candidate_texts))
 
-            joblib.dump(self._candidate2index, self._candidate2index_fpath)
-            print("Saved candidate2index:", self._candidate2index_fpath)
-            joblib.dump(self._phrase2candidates, self._phrase2candidates_fpath)
-            print("Saved candidates:", self._candidates_fpath)
+            print("Saved candidates:", self._staged(self._candidates_fpath))
+
+        CandidateStore.save(self._staged(self._candidate_store_dir), self._candidate2index, self._phrase2candidates)
+        del self._phrase2candidates, self._candidate2index
 
         # vectorize the text representations of the candidates
         stopwords = 'english' if self._params["stop_words"] else None
@@ -162,16 +220,23 @@ class SparseLinker(ContextAwareLinker):
 
         self._vectors = self._vectorizer.fit_transform(corpus)
         
-        joblib.dump(self._vectorizer, self._vectorizer_fpath) 
-        print("Saved vectorizer:", self._vectorizer_fpath)
+        joblib.dump(self._vectorizer, self._staged(self._vectorizer_fpath))
+        print("Saved vectorizer:", self._staged(self._vectorizer_fpath))
 
-        joblib.dump(self._vectors, self._vectors_fpath)
+        joblib.dump(self._vectors, self._staged(self._vectors_fpath))
         self._params["shape"] = self._vectors.shape
-        print("Saved {} candidate feature matrix: {}".format(self._vectors.shape, self._vectors_fpath))
+        print("Saved {} candidate feature matrix: {}".format(self._vectors.shape, self._staged(self._vectors_fpath)))
 
-        with open(self._params_fpath, "w") as fp:
+        with open(self._staged(self._params_fpath), "w") as fp:
             json.dump(self._params, fp)
-        print("Saved params:", self._params_fpath)
+        print("Saved params:", self._staged(self._params_fpath))
+
+        with open(join(self._staging_dir, TRAINED_MARKER), "w") as fp:
+            fp.write("{}\n".format(time()))
+
+        self._candidate_store = None
+        self._install_trained_model()
+        self._candidate_store = CandidateStore(self._candidate_store_dir)
 
     def _ttl2phrases(self, ttl_fpaths):
         """ Given a list of ttl files, extract phrases from them. """
@@ -201,38 +266,66 @@ class SparseLinker(ContextAwareLinker):
         text = phrase.text.strip()
         return Phrase(text, 1, len(text), "http://" + text)
 
-    def _filter_non_linked(self, candidates):
-        linked_candidates = []
-        for candidate in candidates:
-            has_link = candidate.link != ""
-            if has_link:
-                linked_candidates.append(candidate)
+    def _filter_non_linked(self, indices):
+        """ Keeps the indices of the candidates linked to Wikipedia. """
+
+        links = self._candidate_store.get_field("link", indices)
+        linked_indices = indices[np.array([link != "" for link in links], dtype=bool)]
 
         print("Warning: keeping {} of {} candidates that are Wikipedia-linked.".format(
-            len(linked_candidates), len(candidates)))
+            len(linked_indices), len(indices)))
 
-        return linked_candidates
+        return linked_indices
 
-    def link(self, context, phrases):       
+    def _has_phrase(self, phrase):
+        return self._candidate_store is not None and phrase in self._candidate_store
+
+    def _get_candidate_indices(self, phrase):
+        """ Returns an int32 array with the indices of the candidates of the phrase
+        in the candidate feature matrix. """
+
+        if self._candidate_store is None:
+            return np.zeros(0, dtype=np.int32)
+
+        return self._candidate_store.phrase_candidate_ids(phrase)
+
+    def _get_candidates(self, phrase):
+        """ Returns the candidates of the phrase and their indices in the candidate feature matrix. """
+
+        indices = self._get_candidate_indices(phrase)
+        return [self._get_candidate(index) for index in indices], indices
+
+    def _get_candidate(self, index):
+        return self._candidate_store.get(index)
+
+    def _get_candidate_names(self, indices):
+        return self._candidate_store.get_field("name", indices)
+
+    def _link_candidate(self, index, score):
+        """ Builds the linked candidate of a phrase: only the best candidate
+        of a phrase is read from the candidate store. """
+
+        candidate = self._get_candidate(index)
+        candidate.score = score
+        candidate.link = self._get_dbpedia_uri(candidate.wiki, candidate.uris)
+
+        return candidate
+
+    def link(self, context, phrases, params=None):
+        """ :param params a dictionary that overrides the parameters of the model for
+        this call only, e.g. {"use_overlap": False} """
+
+        params = self._link_params(params)
         linked_phrases = []
         context_vector = self._vectorizer.transform([context])
 
         for phrase in phrases:
             try:
-                dphrase = self._default_phrase(phrase)
-                if dphrase in self._phrase2candidates:
+                if self._has_phrase(phrase):
                     # get the candidates
-                    candidates = list(self._phrase2candidates[dphrase])
-                    if self._params["wiki_only"]:
-                        candidates = self._filter_non_linked(candidates)
-
-                    indices = []
-                    for candidate in candidates:
-                        if candidate in self._candidate2index:
-                            indices.append(self._candidate2index[candidate])
-                        else:
-                            print("Warning: candidate '{}' is not indexed".format(candidate))
-                            indices.append(0) # just to make sure lengths are equal
+                    indices = self._get_candidate_indices(phrase)
+                    if params["wiki_only"]:
+                        indices = self._filter_non_linked(indices)
 
                     candidate_vectors = self._vectors[ indices ]
                     print("Retrieved {} candidates for '{}'".format(len(indices), phrase.text))
@@ -240,18 +333,15 @@ class SparseLinker(ContextAwareLinker):
                     # rank the candidates
                     sims = dot(candidate_vectors, context_vector.T)
                     
-                    if self._params["use_overlap"]:
-                        overlap_scores = np.zeros(sims.shape) 
-                        for i, candidate in enumerate(candidates):
-                            overlap_scores[i] = overlap(candidate.name, phrase.text)
+                    if params["use_overlap"]:
+                        names = self._get_candidate_names(indices)
+                        overlap_scores = overlap_many(names, phrase.text).reshape(sims.shape)
                     else:
                         overlap_scores = np.ones(sims.shape)
 
                     scores = np.multiply(sims.toarray(), overlap_scores)
                     best_index = argmax(scores)
-                    best_candidate = candidates[best_index]
-                    best_candidate.score = scores[best_index][0]
-                    best_candidate.link = self._get_dbpedia_uri(best_candidate.wiki, best_candidate.uris)
+                    best_candidate = self._link_candidate(indices[best_index], scores[best_index][0])
                     linked_phrases.append( (phrase, best_candidate) )
                 else:
                     print("Warning: phrase '{}' is not found in the vocabulary of the model".format(phrase))
@@ -263,3 +353,63 @@ class SparseLinker(ContextAwareLinker):
                 linked_phrases.append( (phrase, Candidate()) )
         return linked_phrases
 
+    def link_many(self, documents, params=None):
+        """ Links the phrases of several documents at once: the contexts are vectorized by
+        one transform and the candidates of all the phrases are scored by one sparse product.
+        :param documents a list of (context, phrases) pairs
+        :return a list with the linked phrases of each document (see link) """
+
+        params = self._link_params(params)
+        context_vectors = self._vectorizer.transform([context for context, phrases in documents])
+
+        # gather the candidates of all the phrases: the candidates of the i-th
+        # phrase are the rows offsets[i]:offsets[i+1] of the block
+        phrase_refs = []
+        indices = []
+        offsets = [0]
+        for doc_index, (context, phrases) in enumerate(documents):
+            for phrase_index, phrase in enumerate(phrases):
+                if not self._has_phrase(phrase):
+                    print("Warning: phrase '{}' is not found in the vocabulary of the model".format(phrase))
+                    continue
+
+                phrase_indices = self._get_candidate_indices(phrase)
+                if params["wiki_only"]:
+                    phrase_indices = self._filter_non_linked(phrase_indices)
+                if len(phrase_indices) == 0: continue
+
+                phrase_refs.append((doc_index, phrase_index))
+                indices.append(phrase_indices)
+                offsets.append(offsets[-1] + len(phrase_indices))
+
+        linked_documents = [[(phrase, Candidate()) for phrase in phrases] for context, phrases in documents]
+        if len(indices) == 0:
+            return linked_documents
+
+        indices = np.concatenate(indices)
+        doc_indices = np.repeat([doc_index for doc_index, phrase_index in phrase_refs], np.diff(offsets))
+        print("Retrieved {} candidates for {} phrases of {} documents".format(
+            len(indices), len(phrase_refs), len(documents)))
+
+        # score all the candidates with the contexts of their documents
+        sims = np.asarray(self._vectors[indices].multiply(context_vectors[doc_indices]).sum(axis=1)).ravel()
+        if params["use_overlap"]:
+            names = self._get_candidate_names(indices)
+
+        # scatter the best candidates back to the phrases
+        for i, (doc_index, phrase_index) in enumerate(phrase_refs):
+            phrase = documents[doc_index][1][phrase_index]
+            try:
+                beg, end = offsets[i], offsets[i + 1]
+                scores = sims[beg:end]
+                if params["use_overlap"]:
+                    scores = scores * overlap_many(names[beg:end], phrase.text)
+
+                best_index = argmax(scores)
+                best_candidate = self._link_candidate(indices[beg + best_index], scores[best_index])
+                linked_documents[doc_index][phrase_index] = (phrase, best_candidate)
+            except:
+                print("Error while processing phrase '{}':".format(phrase))
+                print(format_exc())
+
+        return linked_documents
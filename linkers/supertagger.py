@@ -3,7 +3,7 @@ from candidate import Candidate
 import json
 from collections import namedtuple
 from traceback import format_exc
-import requests
+import http_client
 
 
 Tag = namedtuple("Tag", "id score text offsets uris")
@@ -18,7 +18,7 @@ class SuperTagger(ContextAwareLinker):
         nothing = {}
 
         uri = self._endpoint_supertagger.format(text)
-        r = requests.get(uri)
+        r = http_client.get(uri)
         content = json.loads(r.content)
 
         if "all-tags" not in content:
@@ -50,7 +50,7 @@ class SuperTagger(ContextAwareLinker):
 
         return result
 
-    def link(self, context, phrases):
+    def link(self, context, phrases, params=None):
         # link
         tags = self._entity_link(context)
 
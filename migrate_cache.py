@@ -0,0 +1,9 @@
+from diffbot_api import migrate_cache, CACHED_QUERY_DB
+from sys import argv
+
+
+# Converts a Diffbot query cache with pickled requests.Response objects
+# to the compact format: python migrate_cache.py [cache.sqlite]
+
+cache_fpath = argv[1] if len(argv) > 1 else CACHED_QUERY_DB
+migrate_cache(cache_fpath)
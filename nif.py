@@ -0,0 +1,227 @@
+import re
+from rdflib import URIRef
+from candidate import Phrase
+
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+CLASS_REF = "http://www.w3.org/2005/11/its/rdf#taClassRef"
+IDENT_REF = "http://www.w3.org/2005/11/its/rdf#taIdentRef"
+PHRASE = "#Phrase"
+CONTEXT = "#Context"
+STRING = "#isString"
+ANCOR = "#anchorOf"
+BEG = "#beginIndex"
+END = "#endIndex"
+
+
+class NIFSyntaxError(ValueError):
+    """ The input uses a part of the Turtle syntax that is not supported by the streaming parser. """
+    pass
+
+
+_re_token = re.compile(r"""
+    (?P<ws>\s+|\#[^\n]*)
+  | (?P<iri><[^<>"{}|^`\\\x00-\x20]*>)
+  | (?P<long_string>\"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"|'''(?:[^'\\]|\\.|'(?!''))*''')
+  | (?P<string>"(?:[^"\\\n\r]|\\.)*"|'(?:[^'\\\n\r]|\\.)*')
+  | (?P<directive>@prefix|@base|(?i:PREFIX|BASE)(?=\s))
+  | (?P<lang>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*)
+  | (?P<datatype>\^\^)
+  | (?P<pname>(?:[A-Za-z][\w.-]*)?:(?:[\w:%.-]*[\w:%-])?)
+  | (?P<number>[+-]?(?:\d*\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<keyword>(?:a|true|false)(?![\w:.-]))
+  | (?P<punct>[;,.])
+""", re.X | re.S)
+
+_re_iri_unsafe = re.compile(r'[<>"{}|^`\\\x00-\x20]')
+_re_escape = re.compile(r"\\(?:u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8})|(.))", re.S)
+_escapes = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+
+
+def _unescape_match(match):
+    code = match.group(1) or match.group(2)
+    if code:
+        return chr(int(code, 16))
+    if match.group(3) in _escapes:
+        return _escapes[match.group(3)]
+    raise NIFSyntaxError("Bad escape sequence: {}".format(match.group(0)))
+
+
+def _unescape(value):
+    return _re_escape.sub(_unescape_match, value) if "\\" in value else value
+
+
+def to_text(input_ttl):
+    """ The posted documents are bytes in utf-8. """
+
+    return str(input_ttl, "utf-8") if isinstance(input_ttl, bytes) else input_ttl
+
+
+def tokenize(input_ttl):
+    """ Yields the (kind, text) tokens of a Turtle document without the whitespace and comments. """
+
+    input_ttl = to_text(input_ttl)
+    pos = 0
+    while pos < len(input_ttl):
+        match = _re_token.match(input_ttl, pos)
+        if match is None:
+            raise NIFSyntaxError("Unsupported syntax at {}: {}".format(pos, input_ttl[pos:pos + 30]))
+        pos = match.end()
+        if match.lastgroup != "ws":
+            yield match.lastgroup, match.group(match.lastgroup)
+
+
+class _Tokens(object):
+    def __init__(self, input_ttl):
+        self._tokens = tokenize(input_ttl)
+        self._next = None
+        self.advance()
+
+    def advance(self):
+        self._next = next(self._tokens, None)
+
+    def peek(self):
+        return self._next
+
+    def pop(self, kind=None):
+        token = self._next
+        if token is None or (kind is not None and token[0] != kind):
+            raise NIFSyntaxError("Expected {}, found {}".format(kind or "a token", token))
+        self.advance()
+        return token
+
+    def pop_punct(self, punct):
+        token = self.pop("punct")
+        if token[1] != punct:
+            raise NIFSyntaxError("Expected '{}', found '{}'".format(punct, token[1]))
+
+
+def iter_triples(input_ttl):
+    """ Yields the (subject, predicate, object) triples of a Turtle document in one pass.
+    IRIs are returned as strings with the prefixes expanded, literals as strings or numbers.
+    Raises NIFSyntaxError on blank nodes, collections and other unsupported syntax. """
+
+    prefixes = {}
+    tokens = _Tokens(input_ttl)
+
+    def resource(token):
+        kind, text = token
+        if kind == "iri":
+            return text[1:-1]
+        if kind == "pname":
+            prefix, local = text.split(":", 1)
+            if prefix not in prefixes:
+                raise NIFSyntaxError("Undefined prefix: {}".format(prefix))
+            return prefixes[prefix] + local
+        raise NIFSyntaxError("Expected an IRI, found {}".format(text))
+
+    def term():
+        kind, text = tokens.pop()
+        if kind == "keyword":
+            return text == "true" if text != "a" else RDF_TYPE
+        if kind == "number":
+            return float(text) if "." in text or "e" in text.lower() else int(text)
+        if kind in ("string", "long_string"):
+            quote_len = 3 if kind == "long_string" else 1
+            value = _unescape(text[quote_len:-quote_len])
+            next_token = tokens.peek()
+            if next_token is not None and next_token[0] == "lang":
+                tokens.advance()
+            elif next_token is not None and next_token[0] == "datatype":
+                tokens.advance()
+                resource(tokens.pop())
+            return value
+        return resource((kind, text))
+
+    while tokens.peek() is not None:
+        kind, text = tokens.peek()
+        if kind == "directive":
+            tokens.advance()
+            if text.lower().endswith("base"):
+                raise NIFSyntaxError("Base IRIs are not supported")
+            prefix = tokens.pop("pname")[1]
+            if not prefix.endswith(":"):
+                raise NIFSyntaxError("Bad prefix: {}".format(prefix))
+            prefixes[prefix[:-1]] = resource(tokens.pop("iri"))
+            if text.startswith("@"): tokens.pop_punct(".")
+            continue
+
+        subj = resource(tokens.pop())
+        while True:
+            pred = term()
+            while True:
+                yield subj, pred, term()
+                if tokens.peek() == ("punct", ","): tokens.advance()
+                else: break
+
+            punct = tokens.pop("punct")[1]
+            while punct == ";" and tokens.peek() == ("punct", ";"):
+                tokens.advance()  # repeated semicolons are allowed
+            if punct == ";" and tokens.peek() == ("punct", "."):
+                punct = tokens.pop("punct")[1]
+            if punct == ".": break
+            if punct != ";":
+                raise NIFSyntaxError("Unexpected '{}'".format(punct))
+
+
+def parse_nif(input_ttl):
+    """ Extracts the contexts and the phrases of a NIF document in one pass over its triples:
+    returns the same contexts and Phrase tuples as ttl.get_phrases, each phrase once. """
+
+    subjects = []
+    subject2fields = {}
+
+    for subj, pred, obj in iter_triples(input_ttl):
+        if subj not in subject2fields:
+            subject2fields[subj] = {"strings": []}
+            subjects.append(subj)
+        fields = subject2fields[subj]
+
+        if isinstance(obj, str) and obj.endswith(CONTEXT): fields["context"] = fields.get("context", 0) + 1
+        if isinstance(obj, str) and obj.endswith(PHRASE): fields["phrase"] = True
+
+        if pred.endswith(STRING): fields["strings"].append(str(obj))
+        elif pred.endswith(ANCOR):
+            fields["phrase"] = True
+            fields["anchor"] = str(obj)
+        elif pred.endswith(BEG): fields["beg"] = int(obj)
+        elif pred.endswith(END): fields["end"] = int(obj)
+
+    contexts = []
+    phrases = []
+    for subj in subjects:
+        fields = subject2fields[subj]
+        for i in range(fields.get("context", 0)):
+            contexts += fields["strings"]
+
+        if fields.get("phrase", False):
+            phrase, beg, end = fields.get("anchor", ""), fields.get("beg", -1), fields.get("end", -1)
+            if phrase == "" or beg == -1 or end == -1:
+                print("Warning: bad phrase", subj)
+            else:
+                phrases.append(Phrase(phrase, beg, end, URIRef(subj)))
+
+    return contexts, phrases
+
+
+def format_iri(iri):
+    """ Writes an IRI in the Turtle syntax: the characters not allowed
+    in an IRI reference are percent-encoded. """
+
+    iri = _re_iri_unsafe.sub(lambda match: "".join(
+        "%{:02X}".format(byte) for byte in match.group(0).encode("utf-8")), str(iri))
+    return "<{}>".format(iri)
+
+
+def append_links(input_ttl, links):
+    """ Returns the document with the statements linking the phrases appended to it:
+    the input is not re-serialised, so the output size is the input size plus the links.
+    :param links a list of (phrase subject, entity link) pairs """
+
+    output = [to_text(input_ttl), "\n"]
+    for subj, link in links:
+        subj, link = format_iri(subj), format_iri(link)
+        output.append("{} {} {} .\n".format(subj, format_iri(IDENT_REF), link))
+        output.append("{} {} {} .\n".format(subj, format_iri(CLASS_REF), link))
+
+    return "".join(output)
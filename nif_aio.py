@@ -0,0 +1,220 @@
+import asyncio
+import os
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from aiohttp import web
+from ttl import remove_classref, add_nonsense_links, DatasetBuilder
+from archive import Archiver
+from linkers.registry import default_registry
+import http_client
+
+
+# the same settings as in nif_ws.py
+endpoint = "http://localhost:8080/spotlight"
+data_dir = "data/"
+no_classref = False
+save_ttl_data = False
+
+# The linkers that spend most of the time scoring vectors run in a pool of processes,
+# each process loads their models once. The other linkers wait for the Diffbot and
+# Wikidata services, they run in a pool of threads of the server process.
+cpu_bound_linkers = {"sparse", "dense"}
+cpu_workers = int(os.environ.get("KB2VEC_CPU_WORKERS", "2"))
+network_workers = int(os.environ.get("KB2VEC_NETWORK_WORKERS", "32"))
+
+# At most max_active requests of a kind are linked at the same time and at most
+# max_queued wait for their turn: the next ones are refused with 503.
+max_active_cpu = int(os.environ.get("KB2VEC_MAX_ACTIVE_CPU", str(cpu_workers)))
+max_active_network = int(os.environ.get("KB2VEC_MAX_ACTIVE_NETWORK", str(network_workers)))
+max_queued = int(os.environ.get("KB2VEC_MAX_QUEUED", "64"))
+retry_after_sec = 5
+
+preload_linkers = [name.strip() for name in os.environ.get("KB2VEC_PRELOAD", "").split(",") if name.strip()]
+
+# route -> (linker, parameters of the link call), see nif_ws.py
+routes = {
+    "overlap_importance": ("overlap_importance", None),
+    "importance": ("importance", None),
+    "overlap": ("overlap", None),
+    "overlap_case": ("overlap_case", None),
+    "random": ("random", None),
+    "dense_overlap": ("dense", {"tfidf": False, "use_overlap": True}),
+    "sparse": ("sparse", {"tfidf": True, "use_overlap": False}),
+    "sparse_overlap": ("sparse", {"tfidf": True, "use_overlap": True}),
+    "supertagger": ("supertagger", None)}
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Limiter(object):
+    """ Limits the number of the concurrent requests and of the requests waiting for them. """
+
+    def __init__(self, max_active, max_queued):
+        self._semaphore = asyncio.Semaphore(max_active)
+        self._max_queued = max_queued
+        self.queued = 0
+        self.active = 0
+
+    async def __aenter__(self):
+        if self._semaphore.locked() and self.queued >= self._max_queued:
+            raise Overloaded()
+
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.active += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {"active": self.active, "queued": self.queued}
+
+
+_worker_registry = None
+
+
+def _init_worker(names):
+    global _worker_registry
+    _worker_registry = default_registry()
+    _worker_registry.preload(names)
+
+
+def _link_ttl_in_worker(name, input_ttl, params):
+    return _worker_registry.get(name).link_ttl_phrases(input_ttl, params)
+
+
+def _link_ttl(registry, name, input_ttl, params):
+    return registry.get(name).link_ttl_phrases(input_ttl, params)
+
+
+def _ttl_response(request, data):
+    return web.Response(text=data, content_type=request.content_type or "application/x-turtle")
+
+
+def save_data(app, prefix, req_data, resp_data, contexts=None, phrases=None):
+    if save_ttl_data:
+        app["archiver"].archive(prefix, req_data, resp_data, contexts, phrases)
+
+
+async def link_route(request):
+    app = request.app
+    name, params = routes[request.match_info["route"]]
+    input_ttl = await request.read()
+    loop = asyncio.get_event_loop()
+
+    try:
+        if name in cpu_bound_linkers:
+            async with app["cpu_limiter"]:
+                output_ttl, contexts, phrases = await loop.run_in_executor(
+                    app["process_pool"], _link_ttl_in_worker, name, input_ttl, params)
+        else:
+            async with app["network_limiter"]:
+                output_ttl, contexts, phrases = await loop.run_in_executor(
+                    app["thread_pool"], _link_ttl, app["registry"], name, input_ttl, params)
+    except Overloaded:
+        return _overloaded_response()
+
+    save_data(app, request.match_info["route"], input_ttl, output_ttl, contexts, phrases)
+    return _ttl_response(request, output_ttl)
+
+
+def _overloaded_response():
+    return web.Response(status=503, headers={"Retry-After": str(retry_after_sec)},
+                        text="Too many requests, try again later.")
+
+
+# the headers set by aiohttp for the body it sends
+_not_proxied_headers = {"content-length", "content-encoding", "transfer-encoding", "connection"}
+
+
+async def proxy(request):
+    app = request.app
+    input_ttl = await request.read()
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in _not_proxied_headers}
+    loop = asyncio.get_event_loop()
+
+    try:
+        async with app["network_limiter"]:
+            r = await loop.run_in_executor(
+                app["thread_pool"], lambda: http_client.post(endpoint, headers=headers, data=input_ttl))
+    except Overloaded:
+        return _overloaded_response()
+
+    if r.status_code != 200:
+        print("Warning: server returned an error", r)
+        return web.Response()
+
+    r_content = str(r.content, "utf-8")
+    output_ttl = remove_classref(r_content) if no_classref else r_content
+    save_data(app, "proxy", input_ttl, output_ttl)
+    app["archiver"].submit(app["ds"].add_to_dataset, input_ttl)
+
+    response = web.Response(text=output_ttl)
+    for header_name, header_value in r.headers.items():
+        if header_name.lower() not in _not_proxied_headers:
+            response.headers[header_name] = header_value
+    return response
+
+
+async def trivial(request):
+    input_ttl = await request.read()
+    output_ttl, contexts, phrases = add_nonsense_links(input_ttl)
+    save_data(request.app, "trivial", input_ttl, output_ttl, contexts, phrases)
+    request.app["archiver"].submit(request.app["ds"].add_to_dataset, input_ttl, contexts, phrases)
+
+    return _ttl_response(request, output_ttl)
+
+
+async def linkers_stats(request):
+    """ Load time and memory of the linkers of the server process and the load of the pools. """
+
+    app = request.app
+    return web.json_response({"linkers": app["registry"].stats(),
+                              "cpu_bound_linkers": sorted(cpu_bound_linkers),
+                              "cpu": app["cpu_limiter"].stats(),
+                              "network": app["network_limiter"].stats()})
+
+
+async def close_pools(app):
+    app["thread_pool"].shutdown(wait=False)
+    app["process_pool"].shutdown(wait=True)
+    app["archiver"].close()
+
+
+def make_app():
+    app = web.Application()
+    app["ds"] = DatasetBuilder(join(data_dir, "dataset.csv"))
+    app["archiver"] = Archiver(join(data_dir, "archive"))
+    app["registry"] = default_registry()
+    app["thread_pool"] = ThreadPoolExecutor(max_workers=network_workers)
+
+    # the workers are started by a fork server: forking the server process
+    # would copy the locks held by its threads (the archiver, the pools)
+    app["process_pool"] = ProcessPoolExecutor(
+        max_workers=cpu_workers,
+        mp_context=get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=([name for name in preload_linkers if name in cpu_bound_linkers],))
+    app["cpu_limiter"] = Limiter(max_active_cpu, max_queued)
+    app["network_limiter"] = Limiter(max_active_network, max_queued)
+
+    app["registry"].preload([name for name in preload_linkers if name not in cpu_bound_linkers])
+
+    app.router.add_post("/proxy", proxy)
+    app.router.add_post("/trivial", trivial)
+    app.router.add_post("/{route:" + "|".join(routes) + "}", link_route)
+    app.router.add_get("/linkers", linkers_stats)
+    app.on_shutdown.append(close_pools)
+
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host="127.0.0.1", port=5000)
@@ -1,14 +1,12 @@
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify
 import logging
-import requests
-import codecs
+import http_client
+import os
 from os.path import join
-from time import time
-from ttl import remove_classref, add_nonsense_response, DatasetBuilder
-from linkers.baseline import BaselineLinker
-from linkers.sparse import SparseLinker
-from linkers.dense import DenseLinker
-from linkers.supertagger import SuperTagger
+from threading import Lock
+from ttl import remove_classref, add_nonsense_links, DatasetBuilder
+from archive import Archiver
+from linkers.registry import default_registry
 
 
 endpoint = "http://localhost:8080/spotlight"
@@ -16,28 +14,38 @@ data_dir = "data/"
 no_classref = False
 save_ttl_data = False
 ds = DatasetBuilder(join(data_dir, "dataset.csv"))
+# the requests and the dataset are written by a background thread, which is started
+# by the first request that archives, so importing the module has no side effects
+_archiver = None
+_archiver_lock = Lock()
+
+# The linkers are loaded on the first request. The linkers listed in KB2VEC_PRELOAD
+# (comma-separated names, e.g. "sparse,random") are loaded at the startup.
+preload_linkers = [name.strip() for name in os.environ.get("KB2VEC_PRELOAD", "").split(",") if name.strip()]
+linker_registry = default_registry()
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger("nif_ws.py")
 
 
-def save_data(prefix, req_data, resp_data):
-    if save_ttl_data:
-        fid = prefix + "-" + str(time()).replace(".","")
-        request_fpath = join(data_dir, fid + "-request.ttl")
-        with codecs.open(request_fpath, "w", "utf-8") as req:
-            req.write(str(req_data, "utf-8"))
+def get_archiver():
+    global _archiver
+    with _archiver_lock:
+        if _archiver is None:
+            _archiver = Archiver(join(data_dir, "archive"))
+    return _archiver
 
-        response_fpath = join(data_dir, fid + "-response.ttl")
-        with codecs.open(response_fpath, "w", "utf-8") as res:
-            res.write(str(resp_data, "utf-8"))
+
+def save_data(prefix, req_data, resp_data, contexts=None, phrases=None):
+    if save_ttl_data:
+        get_archiver().archive(prefix, req_data, resp_data, contexts, phrases)
 
 
 @app.route("/proxy", methods=['POST'])
 def proxy():
     h = {key: value for key, value in request.headers}
-    r = requests.post(endpoint, headers=h, data=request.data)
+    r = http_client.post(endpoint, headers=h, data=request.data)
 
     resp = Response()
     if r.status_code == 200:
@@ -48,7 +56,7 @@ def proxy():
         resp_data = remove_classref(r_content) if no_classref else r_content
         resp.data = resp_data
         save_data("proxy", request.data, resp_data)
-        ds.add_to_dataset(request.data)
+        get_archiver().submit(ds.add_to_dataset, request.data)
     else:
         log.info("Warning: server returned an error")
         log.info(r)
@@ -60,129 +68,108 @@ def proxy():
 def trivial():
     h = {key: value for key, value in request.headers}
     
-    resp_data = add_nonsense_response(request.data)
+    resp_data, contexts, phrases = add_nonsense_links(request.data)
 
     resp = Response()
     for header_name, header_value in request.headers.items():
         resp.headers[header_name] = header_value
     resp.data = resp_data
-    save_data("trivial", request.data, resp_data)
-    ds.add_to_dataset(request.data)
+    save_data("trivial", request.data, resp_data, contexts, phrases)
+    get_archiver().submit(ds.add_to_dataset, request.data, contexts, phrases)
     
     return resp
 
 
-overlap_importance_linker = BaselineLinker(use_overlap=True, use_importance=True)
-
 @app.route("/overlap_importance", methods=['POST'])
 def overlap_importance():
     response = Response()
     
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = overlap_importance_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("overlap_importance").link_ttl_phrases(request.data)
 
-    save_data("overlap_importance", request.data, response.data)
+    save_data("overlap_importance", request.data, response.data, contexts, phrases)
     
     return response
 
 
-importance_linker = BaselineLinker(use_overlap=False, use_importance=True)
-
 @app.route("/importance", methods=['POST'])
 def importance():
     response = Response()
     
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = importance_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("importance").link_ttl_phrases(request.data)
 
-    save_data("importance", request.data, response.data)
+    save_data("importance", request.data, response.data, contexts, phrases)
     
     return response
 
 
-overlap_linker = BaselineLinker(use_overlap=True, use_importance=False, lower=True)
-
 @app.route("/overlap", methods=['POST'])
 def overlap():
     response = Response()
     
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = overlap_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("overlap").link_ttl_phrases(request.data)
 
-    save_data("overlap", request.data, response.data)
+    save_data("overlap", request.data, response.data, contexts, phrases)
     
     return response
 
 
-overlap_linker_case = BaselineLinker(use_overlap=True, use_importance=False, lower=False)
-
 @app.route("/overlap_case", methods=['POST'])
 def overlap_case():
     response = Response()
 
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = overlap_linker_case.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("overlap_case").link_ttl_phrases(request.data)
 
-    save_data("overlap_case", request.data, response.data)
+    save_data("overlap_case", request.data, response.data, contexts, phrases)
 
     return response
 
 
-random_linker = BaselineLinker(use_overlap=False, use_importance=False)
-
 @app.route("/random", methods=['POST'])
 def random():
     response = Response()
     
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = random_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("random").link_ttl_phrases(request.data)
 
-    save_data("random", request.data, response.data)
+    save_data("random", request.data, response.data, contexts, phrases)
     
     return response
 
-# dense_linker = DenseLinker("data/count-stopwords-3", "data/wiki-news-300d-1M.vec")
-# dense_linker = DenseLinker("data/count-stopwords-3-cc", "data/crawl-300d-2M.vec")
-dense_linker = DenseLinker("data/count-stopwords-10", "data/crawl-300d-2M.vec")
-
 @app.route("/dense_overlap", methods=['POST'])
 def dense_overlap():
     params = {"tfidf": False, "use_overlap": True}
-    dense_linker.set_params(params)
 
     response = Response()
 
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = dense_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("dense").link_ttl_phrases(request.data, params)
 
-    save_data("dense_overlap", request.data, response.data)
+    save_data("dense_overlap", request.data, response.data, contexts, phrases)
 
     return response
 
 
-# sparse_linker = SparseLinker("data/all0")
-# sparse_linker = SparseLinker("data/tfidf-stopwords-2")
-# sparse_linker =  SparseLinker("data/count-stopwords-3")
-sparse_linker =  SparseLinker("data/count-stopwords-10")
-
 @app.route("/sparse", methods=['POST'])
 def sparse():
     params = {"tfidf": True, "use_overlap": False}
-    sparse_linker.set_params(params)
 
     response = Response()
     
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = sparse_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("sparse").link_ttl_phrases(request.data, params)
 
-    save_data("sparse", request.data, response.data)
+    save_data("sparse", request.data, response.data, contexts, phrases)
     
     return response
 
@@ -191,32 +178,38 @@ def sparse():
 @app.route("/sparse_overlap", methods=['POST'])
 def sparse_overlap():
     params = {"tfidf": True, "use_overlap": True}
-    sparse_linker.set_params(params)
 
     response = Response()
     
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = sparse_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("sparse").link_ttl_phrases(request.data, params)
 
-    save_data("sparse_overlap", request.data, response.data)
+    save_data("sparse_overlap", request.data, response.data, contexts, phrases)
     
     return response
 
 
-super_linker = SuperTagger()
 @app.route("/supertagger", methods=['POST'])
 def supertagger():
     response = Response()
 
     for header_name, header_value in request.headers.items():
         response.headers[header_name] = header_value
-    response.data = super_linker.link_ttl(request.data)
+    response.data, contexts, phrases = linker_registry.get("supertagger").link_ttl_phrases(request.data)
 
-    save_data("supertagger", request.data, response.data)
+    save_data("supertagger", request.data, response.data, contexts, phrases)
 
     return response
 
 
+@app.route("/linkers", methods=['GET'])
+def linkers_stats():
+    """ Load time and memory of the linkers. """
+
+    return jsonify(linker_registry.stats())
+
+
 if __name__ == "__main__":
+    linker_registry.preload(preload_linkers)
     app.run(host="127.0.0.1", threaded=True)
\ No newline at end of file
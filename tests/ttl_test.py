@@ -1,4 +1,5 @@
 from ttl import parse_d2kb_ttl
+from nif import parse_nif
 import codecs
 
 input_ttl_fpaths = ["../datasets/kore50.ttl", "../datasets/n3-reuters-128.ttl", "../datasets/dbpedia.ttl"]
@@ -28,4 +29,16 @@ for input_ttl_fpath in input_ttl_fpaths:
     contexts_ttl.close()
 
     print("Output:", phrases_fpath)
-    print("Output:", contexts_fpath)
\ No newline at end of file
+    print("Output:", contexts_fpath)
+
+
+# the streaming parser must find the same contexts and phrases as rdflib
+for input_ttl_fpath in input_ttl_fpaths:
+    with codecs.open(input_ttl_fpath, "r", "utf-8") as in_ttl:
+        input_ttl = in_ttl.read()
+
+    graph, contexts, phrases = parse_d2kb_ttl(input_ttl)
+    nif_contexts, nif_phrases = parse_nif(input_ttl)
+
+    same = sorted(phrases) == sorted(nif_phrases) and sorted(str(c) for c in contexts) == sorted(nif_contexts)
+    print("{}\t{} phrases\t{}".format(input_ttl_fpath, len(nif_phrases), "OK" if same else "MISMATCH"))
@@ -0,0 +1,18 @@
+from diffbot_api import CachedQuery, EL_POL_ENTITY_TYPES, make_query, compact_response, type_name_query
+
+
+# The responses of the types queries of a name must have the hits of
+# the 'type:X name:"..."' query of each type sent upstream.
+
+cq = CachedQuery()
+names = ["Paris", "John", "Madonna", "Berlin", "Alexander Panchenko"]
+type2responses = cq.make_types_queries(EL_POL_ENTITY_TYPES, names)
+
+for name in names:
+    for entity_type in EL_POL_ENTITY_TYPES:
+        response = compact_response(make_query(type_name_query(entity_type, name)))
+        expected = [hit.get("diffbotUri") for hit in response.get("data", [])]
+        found = [hit.get("diffbotUri") for hit in type2responses[name][entity_type].get("data", [])]
+
+        print("{}\t{}\t{} hits\t{}".format(name, entity_type, len(expected),
+                                           "OK" if found == expected else "MISMATCH"))
@@ -1,16 +1,13 @@
 import re
 from rdflib import URIRef, Graph
 import codecs
+from threading import Lock
 from candidate import Phrase
+from nif import parse_nif, append_links, NIFSyntaxError, PHRASE, CONTEXT, STRING, ANCOR, BEG, END
+from traceback import format_exc
 
 
 A = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
-PHRASE = "#Phrase"
-CONTEXT = "#Context"
-STRING = "#isString"
-ANCOR = "#anchorOf"
-BEG = "#beginIndex"
-END = "#endIndex"
 CLASS_URI = URIRef("http://www.w3.org/2005/11/its/rdf#taClassRef")
 LINK_URI = URIRef("http://www.w3.org/2005/11/its/rdf#taIdentRef")
 NONE_URI = URIRef("http://dbpedia.org/nonsense")
@@ -20,14 +17,20 @@ NONE_URI = URIRef("http://dbpedia.org/nonsense")
 class DatasetBuilder(object):
     def __init__(self, dataset_fpath):
         self._dataset_fpath = dataset_fpath
+        self._lock = Lock()
         with codecs.open(self._dataset_fpath, "a", "utf-8") as ttl_f:
             ttl_f.write("targets\tcontext\n")
 
-    def add_to_dataset(self, input_ttl):
-        graph, context, phrases = parse_d2kb_ttl(input_ttl)
-        with codecs.open(self._dataset_fpath, "a", "utf-8") as ttl_f:
-            phrases_str = ", ".join(p.text for p in phrases)
-            ttl_f.write("{}\t{}\n".format(phrases_str, context))
+    def add_to_dataset(self, input_ttl, contexts=None, phrases=None):
+        """ :param contexts, phrases the contexts and the phrases of the input if they
+        are parsed already (see TTLinker.link_ttl_phrases) """
+
+        if contexts is None or phrases is None:
+            contexts, phrases = parse_d2kb_phrases(input_ttl)
+
+        phrases_str = ", ".join(p.text for p in phrases)
+        with self._lock, codecs.open(self._dataset_fpath, "a", "utf-8") as ttl_f:
+            ttl_f.write("{}\t{}\n".format(phrases_str, contexts))
 
 
 def parse_d2kb_ttl(input_ttl):
@@ -38,11 +41,46 @@ def parse_d2kb_ttl(input_ttl):
     return g, contexts, phrases
 
 
+def parse_d2kb_input(input_ttl):
+    """ Extracts the contexts and the phrases without building a graph. The documents which
+    are not supported by the streaming parser are parsed by rdflib: the graph is returned
+    then (otherwise None) and is used to write the links (see add_links). """
+
+    try:
+        contexts, phrases = parse_nif(input_ttl)
+        return None, contexts, phrases
+    except NIFSyntaxError:
+        print("Warning: falling back to rdflib:", format_exc().strip().split("\n")[-1])
+        return parse_d2kb_ttl(input_ttl)
+
+
+def parse_d2kb_phrases(input_ttl):
+    graph, contexts, phrases = parse_d2kb_input(input_ttl)
+    return contexts, phrases
+
+
+def add_links(input_ttl, graph, links):
+    """ Returns the document with the links of the phrases (taIdentRef and taClassRef).
+    :param graph the graph of the document returned by parse_d2kb_input
+    :param links a list of (phrase subject, entity link) pairs """
+
+    if graph is None:
+        return append_links(input_ttl, links)
+
+    for subj, link in links:
+        graph.add( (subj, LINK_URI, URIRef(link)) )
+        graph.add( (subj, CLASS_URI, URIRef(link)) )
+
+    return str(graph.serialize(format='n3', encoding="utf-8"), "utf-8")
+
+
 def get_phrases(g):
-    """ Collect the context and phrases """
+    """ Collect the context and phrases: each phrase once, as nif.parse_nif does
+    (a phrase subject matches several triples, e.g. its type and its anchor). """
     
     contexts = []
     phrases = []
+    phrase_subjects = set()
     
     for subj, pred, obj in g:
         p = str(pred)
@@ -56,7 +94,8 @@ def get_phrases(g):
                     contexts.append(obj_s)
 
         # catch the phrases to disambiguate 
-        if o.endswith(PHRASE) or p.endswith(ANCOR):
+        if (o.endswith(PHRASE) or p.endswith(ANCOR)) and subj not in phrase_subjects:
+            phrase_subjects.add(subj)
             phrase = ""
             end = -1
             beg = -1
@@ -75,18 +114,20 @@ def get_phrases(g):
 
 
 def add_nonsense_response(input_ttl):
-    graph, context, phrases = parse_d2kb_ttl(input_ttl)
+    output_ttl, contexts, phrases = add_nonsense_links(input_ttl)
+    return output_ttl
+
+
+def add_nonsense_links(input_ttl):
+    """ Links all the phrases to NONE_URI: returns the output and the contexts and phrases of the input. """
+
+    graph, contexts, phrases = parse_d2kb_input(input_ttl)
     
     # add new triples that correspond to the links of the disambiguation links
-    print("# triples input:", len(graph))
-    for phrase in phrases:
-        graph.add( (phrase.subj, CLASS_URI, NONE_URI) )
-        graph.add( (phrase.subj, LINK_URI, NONE_URI) )
-    print("# triples output:", len(graph))
-
-    output_ttl = str(graph.serialize(format='n3', encoding="utf-8"), "utf-8")
+    print("# phrases:", len(phrases))
+    output_ttl = add_links(input_ttl, graph, [(phrase.subj, NONE_URI) for phrase in phrases])
     
-    return output_ttl
+    return output_ttl, contexts, phrases
 
 
 def remove_classref(text):
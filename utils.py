@@ -1,6 +1,8 @@
 from math import log
 import os 
 from difflib import SequenceMatcher
+import numpy as np
+from cache.lru import LRUCache
 
 
 # This is the project root directory assuming that utils.py is in the root directory
@@ -29,21 +31,46 @@ def dbpedia2wikipedia(url, to_en=True):
     return new_url
 
 
-def longest_common_substring(s1, s2, lower=True):
-    if lower:
-        s1 = s1.lower()
-        s2 = s2.lower()
+# The overlap scores are memoised by the (lowercased if lower=True) pair of strings
+OVERLAP_CACHE_CAPACITY = 500000
+_lcs_cache = LRUCache(OVERLAP_CACHE_CAPACITY)
+_overlap_cache = LRUCache(OVERLAP_CACHE_CAPACITY)
+
+
+def _normalise_pair(s1, s2, lower):
+    return (s1.lower(), s2.lower()) if lower else (s1, s2)
+
 
+def _find_longest_match(s1, s2):
     match = SequenceMatcher(None, s1, s2).find_longest_match(0, len(s1), 0, len(s2))
-    substring = s1[match.a: match.a + match.size]
+    return s1[match.a: match.a + match.size]
+
+
+def longest_common_substring(s1, s2, lower=True):
+    key = _normalise_pair(s1, s2, lower)
+    substring = _lcs_cache.get(key)
+    if substring is None:
+        substring = _find_longest_match(key[0], key[1])
+        _lcs_cache.put(key, substring)
 
     return substring
 
 
+def _overlap_length(key):
+    """ The length of the longest common substring of a normalised pair (memoised). """
+
+    max_overlap = _overlap_cache.get(key)
+    if max_overlap is None:
+        direct = _find_longest_match(key[0], key[1])
+        inverse = _find_longest_match(key[1], key[0])
+        max_overlap = max(len(direct), len(inverse))
+        _overlap_cache.put(key, max_overlap)
+
+    return max_overlap
+
+
 def overlap(s1, s2, lower=True):
-    direct = longest_common_substring(s1, s2, lower)
-    inverse = longest_common_substring(s2, s1, lower)
-    max_overlap = float(max(len(direct), len(inverse)))
+    max_overlap = float(_overlap_length(_normalise_pair(s1, s2, lower)))
     if max_overlap < 3:
         return 0.0
     else:
@@ -51,6 +78,67 @@ def overlap(s1, s2, lower=True):
         return max_overlap / max_len
 
 
+def overlap_cache_stats():
+    """ Hit/miss counters of the memoised overlap and longest_common_substring. """
+
+    return {"overlap": _overlap_cache.stats(),
+            "longest_common_substring": _lcs_cache.stats()}
+
+
+# SequenceMatcher uses the "autojunk" heuristic for the strings of this length or longer
+AUTOJUNK_MIN_LEN = 200
+
+
+def overlap_many(names, s2, lower=True):
+    """ Computes overlap(name, s2, lower) for many names at once: the names that are not
+    memoised are scored by one dynamic programming pass over the characters of s2
+    that finds the lengths of their longest common substrings. Returns a numpy array. """
+
+    scores = np.zeros(len(names))
+    lengths = {}  # name index -> length of the longest common substring
+
+    s2_cmp = s2.lower() if lower else s2
+    keys = [_normalise_pair(name, s2, lower) for name in names]
+
+    # the long strings are scored by SequenceMatcher to keep its heuristics
+    short = []
+    for i, key in enumerate(keys):
+        max_overlap = _overlap_cache.get(key)
+        if max_overlap is not None:
+            lengths[i] = max_overlap
+        elif len(key[0]) < AUTOJUNK_MIN_LEN and len(s2_cmp) < AUTOJUNK_MIN_LEN:
+            short.append(i)
+        else:
+            lengths[i] = _overlap_length(key)
+
+    max_len = max([len(keys[i][0]) for i in short] + [0])
+    if len(short) > 0 and max_len > 0 and len(s2_cmp) > 0:
+        # the characters of the names as a padded matrix of code points
+        chars = np.full((len(short), max_len), -1, dtype=np.int64)
+        for row, i in enumerate(short):
+            chars[row, :len(keys[i][0])] = [ord(c) for c in keys[i][0]]
+
+        # suffix_lengths[:, j] is the length of the common suffix of s2[:k] and name[:j]
+        suffix_lengths = np.zeros((len(short), max_len + 1), dtype=np.int32)
+        longest = np.zeros(len(short), dtype=np.int32)
+        for c in s2_cmp:
+            matches = chars == ord(c)
+            suffix_lengths[:, 1:] = np.where(matches, suffix_lengths[:, :-1] + 1, 0)
+            np.maximum(longest, suffix_lengths.max(axis=1), out=longest)
+    else:
+        longest = np.zeros(len(short), dtype=np.int32)
+
+    for row, i in enumerate(short):
+        lengths[i] = int(longest[row])
+        _overlap_cache.put(keys[i], lengths[i])
+
+    for i, max_overlap in lengths.items():
+        if max_overlap >= 3:
+            scores[i] = float(max_overlap) / float(max(len(names[i]), len(s2)))
+
+    return scores
+
+
 def truncated_log(x):
     if x > 0: return log(x)
     else: return 0.0    